@@ -0,0 +1,78 @@
+from typing import Dict, List, Optional
+
+from .nodes import GeoNode
+
+
+class NodeRegistry(object):
+    """
+    Stable integer ids of the nodes of a system
+
+    Ids are given out in order of registration and never reused while the
+    system lives. The ordered node list is cached and kept up to date by
+    add, it is only rebuilt after a node is removed. Positions in it are
+    rebuilt lazily after a node is inserted before the end.
+    """
+
+    ids: Dict[GeoNode, int]
+    by_id: Dict[int, GeoNode]
+    next_id: int
+    order: Optional[List[GeoNode]]
+    positions: Optional[Dict[GeoNode, int]]
+
+    def __init__(self, nodes: List[GeoNode] = ()):
+        self.ids = {}
+        self.by_id = {}
+        self.next_id = 0
+        self.order = None
+        self.positions = None
+
+        for node in nodes:
+            self.add(node)
+
+    def __contains__(self, node: GeoNode) -> bool:
+        return node in self.ids
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, node: GeoNode, position: Optional[int] = None) -> int:
+        """
+        position of the node in the ordered list, None puts it at the end
+        """
+
+        if node in self.ids:
+            raise Exception(f'{node} is already in the system')
+
+        node_id = self.next_id
+        self.next_id += 1
+        self.ids[node] = node_id
+        self.by_id[node_id] = node
+
+        if self.order is None:
+            return node_id
+
+        if position is None or position >= len(self.order):
+            if self.positions is not None:
+                self.positions[node] = len(self.order)
+            self.order.append(node)
+        else:
+            self.order.insert(position, node)
+            self.positions = None
+        return node_id
+
+    def remove(self, node: GeoNode):
+        del self.by_id[self.ids.pop(node)]
+        self.invalidate()
+
+    def invalidate(self):
+        self.order = None
+        self.positions = None
+
+    def set_order(self, nodes: List[GeoNode]):
+        self.order = nodes
+        self.positions = None
+
+    def position(self, node: GeoNode) -> int:
+        if self.positions is None:
+            self.positions = {node: i for i, node in enumerate(self.order)}
+        return self.positions[node]
@@ -5,8 +5,8 @@ from ..product import ProductList, Product
 
 
 class Consumer(GeoNode):
+    __slots__ = ('order',)
     order: ProductList
-    rest: ProductList
 
     def __init__(self, name='Потребитель', *order: Product):
         super().__init__(name)
@@ -14,6 +14,7 @@ class Consumer(GeoNode):
 
     def __copy__(self) -> 'Consumer':
         new = Consumer(self.name, *self.order)
+        new.pos = self.pos
         new.linked = copy(self.linked)
         new.order = copy(self.order)
         return new
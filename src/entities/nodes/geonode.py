@@ -1,14 +1,20 @@
 from copy import copy
 from typing import *
 
+from ..product import ProductLedger
 from ..road import Road
 
 
 class GeoNode(object):
-    def __init__(self, name=""):
+    __slots__ = ('name', 'pos', 'linked', 'balance', 'linked_id')
+    revision: int = 0  # bumped on every change of links between any nodes
+    balance: Optional[ProductLedger]  # set by TransportSystem.init_balance
+
+    def __init__(self, name="", pos: Optional[Tuple[float, float]] = None):
         self.name: str = name
+        self.pos = pos
         self.linked: Dict[GeoNode, Road] = {}
-        self.balance: Dict[str, int] = {}
+        self.balance = None
 
     def __str__(self):
         return self.name
@@ -23,7 +29,7 @@ class GeoNode(object):
         return id(self)
 
     def __copy__(self) -> 'GeoNode':
-        new = GeoNode(self.name)
+        new = GeoNode(self.name, self.pos)
         new.linked = copy(self.linked)
         return new
 
@@ -33,8 +39,12 @@ class GeoNode(object):
     def time(self, other: 'GeoNode'):
         return self.linked[other].time if self.is_linked(other) else None
 
+    def weight(self, other: 'GeoNode', metric='dist'):
+        return getattr(self.linked[other], metric) if self.is_linked(other) else None
+
     def add_node(self, other: 'GeoNode', road: Road, symmetric=True):
         self.linked[other] = road
+        GeoNode.revision += 1
         if symmetric:
             other.add_node(self, road, symmetric=False)
 
@@ -42,6 +52,7 @@ class GeoNode(object):
         if not self.is_linked(other):
             return
         self.linked.pop(other)
+        GeoNode.revision += 1
         if symmetric:
             other.delete_node(self, symmetric=False)
 
@@ -55,6 +66,7 @@ class GeoNode(object):
 
     def update(self, other: 'GeoNode'):
         self.name = other.name
+        self.pos = other.pos
         self.unlink()
         for node, road in other.linked.items():
             self.add_node(node, road)
@@ -6,12 +6,15 @@ from ..transport import Transport
 
 
 class Parking(GeoNode):
+    __slots__ = ('transport',)
+
     def __init__(self, name='Стоянка'):
         super(Parking, self).__init__(name)
         self.transport: List[Transport] = []
 
     def __copy__(self) -> 'Parking':
         new = Parking(self.name)
+        new.pos = self.pos
         new.linked = copy(self.linked)
         new.transport = copy(self.transport)
         return new
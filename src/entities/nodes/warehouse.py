@@ -5,8 +5,8 @@ from ..product import ProductList, Product
 
 
 class Warehouse(GeoNode):
+    __slots__ = ('stock',)
     stock: ProductList
-    rest: ProductList
 
     def __init__(self, name="Склад", *stock: Product):
         super(Warehouse, self).__init__(name)
@@ -14,6 +14,7 @@ class Warehouse(GeoNode):
 
     def __copy__(self) -> 'Warehouse':
         new = Warehouse(self.name, *self.stock)
+        new.pos = self.pos
         new.linked = copy(self.linked)
         new.stock = copy(self.stock)
         return new
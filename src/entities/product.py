@@ -1,10 +1,16 @@
+import threading
+from contextlib import nullcontext
 from copy import copy
-from typing import Union, Optional
+from typing import Union, Optional, Dict, List, Tuple, ContextManager, TYPE_CHECKING
 
-from .nodes.geonode import GeoNode
+import numpy as np
+
+if TYPE_CHECKING:
+    from .nodes.geonode import GeoNode
 
 
 class Product:
+    __slots__ = ('name', 'amount', 'volume')
     __match_args__ = ('name',)
 
     def __init__(self, name: str, amount: int, volume=0.1):
@@ -45,69 +51,238 @@ class Product:
         return self.split(new_amount)
 
 
+class ProductCatalog(object):
+    """
+    Product names interned to dense integer ids
+
+    Ledgers index their count vectors by these ids, volumes keeps the
+    volume of one item of every product. Every system has its own
+    catalog, ledgers of different catalogs can't be mixed. Only a shared
+    catalog locks when it adds names.
+    """
+
+    names: List[str]
+    ids: Dict[str, int]
+    volumes: np.ndarray
+    lock: ContextManager
+
+    def __init__(self, shared=False):
+        self.names = []
+        self.ids = {}
+        self.volumes = np.zeros(0)
+        self.lock = threading.RLock() if shared else nullcontext()
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def id(self, name: str) -> int:
+        product_id = self.ids.get(name)
+        if product_id is not None:
+            return product_id
+
+        with self.lock:
+            if name not in self.ids:
+                self.volumes = np.append(self.volumes, 0.0)
+                self.names.append(name)
+                self.ids[name] = len(self.names) - 1
+            return self.ids[name]
+
+    def register(self, product: Product) -> int:
+        with self.lock:
+            product_id = self.id(product.name)
+            self.volumes[product_id] = product.volume
+            return product_id
+
+
+class ProductLedger(object):
+    """
+    Product amounts as a count vector over a catalog
+
+    Works as a name -> amount mapping too, absent products count as 0.
+    With a journal every change is recorded there and can be undone.
+    A ledger made without a catalog gets a new one of its own.
+    """
+
+    __slots__ = ('counts', 'journal', 'catalog')
+    counts: np.ndarray
+    journal: Optional['LedgerJournal']
+    catalog: ProductCatalog
+
+    def __init__(self, counts: np.ndarray = None, journal: 'LedgerJournal' = None, catalog: ProductCatalog = None):
+        self.catalog = ProductCatalog() if catalog is None else catalog
+        self.counts = np.zeros(len(self.catalog), dtype=np.int64) if counts is None else counts
+        self.journal = journal
+
+    @classmethod
+    def from_products(cls, *product_lists: 'ProductList', catalog: ProductCatalog = None) -> 'ProductLedger':
+        ledger = cls(catalog=catalog)
+        for products in product_lists:
+            ledger.deposit(products)
+        return ledger
+
+    def __copy__(self) -> 'ProductLedger':
+        return ProductLedger(self.counts.copy(), catalog=self.catalog)
+
+    def __repr__(self) -> str:
+        return repr(self.to_products())
+
+    def _fit(self, size: int = None) -> np.ndarray:
+        # counts of the first size products, the vector grows when needed
+        size = len(self.catalog) if size is None else size
+        if len(self.counts) < size:
+            self.counts = np.concatenate((self.counts, np.zeros(size - len(self.counts), dtype=np.int64)))
+        return self.counts[:size]
+
+    def _other(self, other: 'ProductLedger') -> 'ProductLedger':
+        if other.catalog is not self.catalog:
+            raise Exception('Ledgers of different product catalogs')
+        return other
+
+    def _change(self, ids: Union[List[int], slice], amounts: np.ndarray):
+        np.add.at(self._fit(), ids, amounts)
+        if self.journal is not None:
+            self.journal.append((self, ids, amounts))
+
+    def __getitem__(self, name: str) -> int:
+        product_id = self.catalog.ids.get(name)
+        if product_id is None or product_id >= len(self.counts):
+            return 0
+        return int(self.counts[product_id])
+
+    def __setitem__(self, name: str, amount: int):
+        self._change([self.catalog.id(name)], np.array([amount - self[name]]))
+
+    def __contains__(self, name: str) -> bool:
+        return self[name] != 0
+
+    def cross(self, other: 'ProductLedger') -> 'ProductLedger':
+        size = len(self.catalog)
+        counts = np.minimum(self._fit(size), self._other(other)._fit(size))
+        return ProductLedger(counts, catalog=self.catalog)
+
+    def minus(self, other: Union['ProductLedger', 'ProductList']):
+        if isinstance(other, ProductList):
+            other = ProductLedger.from_products(other, catalog=self.catalog)
+        size = len(self.catalog)
+        self._change(slice(0, size), -self._other(other)._fit(size))
+
+    def add(self, other: 'ProductLedger'):
+        size = len(self.catalog)
+        self._change(slice(0, size), self._other(other)._fit(size).copy())
+
+    def covers(self, other: 'ProductLedger') -> bool:
+        size = len(self.catalog)
+        return bool(np.all(self._fit(size) >= self._other(other)._fit(size)))
+
+    def is_empty(self) -> bool:
+        return not self.counts.any()
+
+    @property
+    def amount(self) -> int:
+        return int(self.counts.sum())
+
+    @property
+    def volume(self) -> float:
+        volumes = self.catalog.volumes
+        return float(self._fit(len(volumes)) @ volumes)
+
+    def deposit(self, products: 'ProductList'):
+        ids = [self.catalog.register(product) for product in products]
+        self._change(ids, np.array([product.amount for product in products], dtype=np.int64))
+
+    def withdraw(self, products: 'ProductList') -> 'ProductList':
+        """
+        Takes as much of the products as there is, returns what was taken
+        """
+
+        ids = [self.catalog.id(product.name) for product in products]
+        available = self._fit()[ids]
+        amounts = np.minimum([product.amount for product in products], available)
+        self._change(ids, -amounts)
+
+        write_off = ProductList()
+        for product, amount, left in zip(products, amounts.tolist(), available.tolist()):
+            if left:
+                write_off.append(Product(product.name, amount, product.volume))
+        return write_off
+
+    def to_products(self) -> 'ProductList':
+        catalog = self.catalog
+        return ProductList(Product(catalog.names[i], int(self.counts[i]), float(catalog.volumes[i]))
+                           for i in np.flatnonzero(self.counts))
+
+
+class LedgerJournal(list[Tuple[ProductLedger, Union[List[int], slice], np.ndarray]]):
+    """
+    Undo log of ledger changes
+
+    A savepoint is the journal length, rolling back to it reverts the
+    later changes in reverse order, so it costs O(changes).
+    """
+
+    def savepoint(self) -> int:
+        return len(self)
+
+    def rollback(self, savepoint: int):
+        while len(self) > savepoint:
+            ledger, ids, amounts = self.pop()
+            np.subtract.at(ledger.counts, ids, amounts)
+
+
 class ProductList(list[Product]):
     def by_name(self, name: str) -> Product | None:
-        found = list(filter(lambda node: node.name == name, self))
-        return found[0] if found else None
+        return next((product for product in self if product.name == name), None)
+
+    def _by_names(self) -> Dict[str, Product]:
+        by_names = {}
+        for product in self:
+            by_names.setdefault(product.name, product)
+        return by_names
 
     def __mul__(self, other: 'ProductList') -> 'ProductList':
         return self.cross(other)
 
     def cross(self, other: 'ProductList') -> 'ProductList':
         cross_list = ProductList()
+        other_products = other._by_names()
         for product in self:
-            stock_prod = other.by_name(product.name)
+            stock_prod = other_products.get(product.name)
             if stock_prod:
                 cross = Product(product.name, min(product.amount, stock_prod.amount))
                 cross_list.append(cross)
         return cross_list
 
     def minus(self, other: 'ProductList'):
+        self_products = self._by_names()
         for product in other:
-            self_prod = self.by_name(product.name)
+            self_prod = self_products.get(product.name)
             if not self_prod:
                 continue
 
             if self_prod.amount == product.amount:
                 self.remove(self_prod)
+                self_products[product.name] = self.by_name(product.name)
             else:
                 self_prod.amount -= product.amount
 
     def add(self, other: 'ProductList'):
+        self_products = self._by_names()
         for product in other:
-            self_prod = self.by_name(product.name)
+            self_prod = self_products.get(product.name)
             if self_prod is None:
-                self.append(copy(product))
+                self_products[product.name] = copy(product)
+                self.append(self_products[product.name])
             else:
                 self_prod.amount += product.amount
 
     def is_empty(self):
         return len(self) == 0
 
-    def from_balance(self, node: GeoNode) -> 'ProductList':
-        write_off = ProductList()
-        for prod in self:
-            if prod.name not in node.balance or node.balance[prod.name] == 0:
-                continue
-
-            amount = min(prod.amount, node.balance[prod.name])
-
-            node.balance[prod.name] -= amount
-            if node.balance[prod.name] == 0:
-                del node.balance[prod.name]
+    def from_balance(self, node: 'GeoNode') -> 'ProductList':
+        return node.balance.withdraw(self)
 
-            new_prod = copy(prod)
-            new_prod.amount = amount
-            write_off.append(new_prod)
-
-        return write_off
-
-    def to_balance(self, node: GeoNode):
-        for prod in self:
-            if prod.name not in node.balance:
-                node.balance[prod.name] = prod.amount
-            else:
-                node.balance[prod.name] += prod.amount
+    def to_balance(self, node: 'GeoNode'):
+        node.balance.deposit(self)
 
     @property
     def volume(self) -> float:
@@ -1,7 +1,15 @@
 class Road(object):
+    __slots__ = ('dist', 'time')
+    revision: int = 0  # bumped on every change of the length of any road
+
     def __init__(self, dist=1.0, time=1.0):
         self.dist: float = dist
         self.time: float = time
 
+    def __setattr__(self, name, value):
+        if hasattr(self, name):
+            Road.revision += 1
+        object.__setattr__(self, name, value)
+
     def __repr__(self):
         return f'↔{self.dist} ⌛{self.time}'
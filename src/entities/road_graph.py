@@ -0,0 +1,139 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from .nodes import GeoNode, Consumer
+
+
+class RoadGraph(object):
+    """
+    Frozen CSR view of the roads between nodes
+
+    Roads leaving nodes[i] are neighbors[offsets[i]:offsets[i + 1]] with
+    the matching dist and time values. The view is built once and never
+    changes, TransportSystem.graph builds a new one when roads change.
+
+    Routes can be encoded as arrays of node positions, their costs are then
+    looked up in the sparse road matrix for all of them at once.
+    """
+
+    nodes: List[GeoNode]
+    index: Dict[GeoNode, int]
+    offsets: np.ndarray
+    neighbors: np.ndarray
+    dist: np.ndarray
+    time: np.ndarray
+    consumers: np.ndarray
+
+    def __init__(self, nodes: List[GeoNode], revision: Tuple[int, ...] = ()):
+        self.revision = revision
+        self.nodes = list(nodes)
+        self.index = {node: i for i, node in enumerate(self.nodes)}
+
+        offsets, neighbors, dist, time = [0], [], [], []
+        for node in self.nodes:
+            for other, road in node.linked.items():
+                neighbors.append(self.index[other])
+                dist.append(road.dist)
+                time.append(road.time)
+            offsets.append(len(neighbors))
+
+        self.offsets = np.array(offsets, dtype=np.int32)
+        self.neighbors = np.array(neighbors, dtype=np.int32)
+        self.dist = np.array(dist, dtype=np.float64)
+        self.time = np.array(time, dtype=np.float64)
+        self.consumers = np.array([isinstance(node, Consumer) for node in self.nodes], dtype=bool)
+        for arr in (self.offsets, self.neighbors, self.dist, self.time, self.consumers):
+            arr.setflags(write=False)
+
+        self._matrices: Dict[str, csr_matrix] = {}
+        self._roads: Optional[csr_matrix] = None
+        self._adjacency: Dict[Tuple[str, bool], List[List[Tuple[int, float]]]] = {}
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def same_roads(self, other: 'RoadGraph') -> bool:
+        if len(self.nodes) != len(other.nodes) or any(a is not b for a, b in zip(self.nodes, other.nodes)):
+            return False
+        return all(np.array_equal(getattr(self, name), getattr(other, name))
+                   for name in ('offsets', 'neighbors', 'dist', 'time'))
+
+    def weights(self, metric='dist') -> np.ndarray:
+        return getattr(self, metric)
+
+    def matrix(self, metric='dist') -> csr_matrix:
+        if metric not in self._matrices:
+            n = len(self.nodes)
+            self._matrices[metric] = csr_matrix((self.weights(metric), self.neighbors, self.offsets), shape=(n, n))
+        return self._matrices[metric]
+
+    def adjacency(self, metric='dist', reverse=False) -> List[List[Tuple[int, float]]]:
+        """
+        Rows of (neighbor, weight) pairs for loops that run in Python
+
+        With reverse=True row i lists the roads coming into nodes[i].
+        """
+
+        key = (metric, reverse)
+        if key not in self._adjacency:
+            matrix = self.matrix(metric)
+            if reverse:
+                matrix = matrix.transpose().tocsr()
+
+            offsets = matrix.indptr.tolist()
+            neighbors = matrix.indices.tolist()
+            weights = matrix.data.tolist()
+            self._adjacency[key] = [list(zip(neighbors[begin:end], weights[begin:end]))
+                                    for begin, end in zip(offsets[:-1], offsets[1:])]
+        return self._adjacency[key]
+
+    def weights_to(self, ids: np.ndarray, target: int, metric='dist') -> np.ndarray:
+        """
+        Weights of the roads from ids to nodes[target], inf where there is no road
+        """
+
+        incoming = dict(self.adjacency(metric, reverse=True)[target])
+        return np.fromiter((incoming.get(i, np.inf) for i in ids.tolist()), dtype=np.float64, count=len(ids))
+
+    def road_weights(self, tails: np.ndarray, heads: np.ndarray, metric='dist') -> np.ndarray:
+        """
+        Weights of the roads tails[k] -> heads[k], inf where there is no road
+        """
+
+        if not len(tails):
+            return np.zeros(0)
+        if self._roads is None:
+            # 1 + position of every road in neighbors, missing roads read as 0
+            n = len(self.nodes)
+            self._roads = csr_matrix((np.arange(1, len(self.neighbors) + 1), self.neighbors, self.offsets),
+                                     shape=(n, n))
+        roads = np.asarray(self._roads[tails, heads]).ravel() - 1
+        return np.append(self.weights(metric), np.inf)[roads]
+
+    def encode(self, nodes: Sequence[GeoNode]) -> np.ndarray:
+        return np.fromiter((self.index[node] for node in nodes), dtype=np.int32, count=len(nodes))
+
+    def decode(self, ids: np.ndarray) -> List[GeoNode]:
+        return [self.nodes[i] for i in ids]
+
+    def cost(self, ids: np.ndarray, metric='dist') -> float:
+        return float(self.road_weights(ids[:-1], ids[1:], metric).sum())
+
+    def costs(self, routes: Sequence[np.ndarray], metric='dist') -> np.ndarray:
+        """
+        Costs of many encoded routes in one pass over their joined ids
+        """
+
+        if not len(routes):
+            return np.zeros(0)
+
+        lengths = np.array([len(ids) for ids in routes])
+        flat = np.concatenate(routes)
+        labels = np.repeat(np.arange(len(routes)), lengths)[:-1]
+        weights = self.road_weights(flat[:-1], flat[1:], metric)
+
+        inner = np.ones(len(flat) - 1, dtype=bool)
+        inner[np.cumsum(lengths)[:-1] - 1] = False
+        return np.bincount(labels[inner], weights[inner], minlength=len(routes))
@@ -0,0 +1,250 @@
+import heapq
+import time
+from typing import Dict, List, Tuple
+
+from .nodes import GeoNode
+from .road_map import RoadMap, INF, synchronized
+from .route import Route
+from .system import TransportSystem
+
+WITNESS_LIMIT = 64
+
+
+class HierarchyRoadMap(RoadMap):
+    """
+    Contraction hierarchy over the roads of a system
+
+    The index is built once per network (build_time keeps its cost),
+    after that point-to-point queries run a bidirectional search over
+    upward edges only and unpack shortcuts into the original roads.
+    Nodes are contracted in order of a priority estimate that is only
+    updated for the neighbours of every contracted node.
+    """
+
+    rank: List[int]
+    up: List[List[Tuple[int, float]]]
+    down: List[List[Tuple[int, float]]]
+    mid: Dict[Tuple[int, int], int]
+    build_time: float | None
+
+    def __init__(self, sys: TransportSystem, cache_dir: str | None = None, metric: str = 'dist'):
+        super(HierarchyRoadMap, self).__init__(sys, cache_dir=cache_dir, metric=metric)
+        self._reset()
+
+    def _witness(self, out: List[Dict[int, float]], source: int, skip: int, limit: float) -> Dict[int, float]:
+        dist = {source: 0.0}
+        heap = [(0.0, source)]
+        settled = 0
+
+        while heap and settled < WITNESS_LIMIT:
+            current_dist, current = heapq.heappop(heap)
+            if current_dist > dist[current]:
+                continue
+            if current_dist > limit:
+                break
+            settled += 1
+
+            for other, weight in out[current].items():
+                other_dist = current_dist + weight
+                if other != skip and other_dist < dist.get(other, INF):
+                    dist[other] = other_dist
+                    heapq.heappush(heap, (other_dist, other))
+
+        return dist
+
+    @staticmethod
+    def _wanted(out, inc, node: int, source: int) -> Dict[int, float]:
+        # paths source -> node -> target not beaten by a direct road
+        in_weight = inc[node][source]
+        direct = out[source]
+        return {target: in_weight + out_weight for target, out_weight in out[node].items()
+                if target != source and direct.get(target, INF) > in_weight + out_weight}
+
+    def _shortcuts(self, out, inc, node: int) -> List[Tuple[int, int, float]]:
+        shortcuts = []
+        for source in inc[node]:
+            wanted = self._wanted(out, inc, node, source)
+            if not wanted:
+                continue
+
+            witness = self._witness(out, source, node, max(wanted.values()))
+            shortcuts += [(source, target, weight) for target, weight in wanted.items()
+                          if witness.get(target, INF) > weight]
+        return shortcuts
+
+    def _priority(self, out, inc, node: int, contracted_neighbours: List[int], level: List[int]) -> int:
+        """
+        Estimated edge difference of contracting node, only direct roads
+        count as witnesses here, so no witness search is run
+        """
+
+        shortcuts = sum(len(self._wanted(out, inc, node, source)) for source in inc[node])
+        edge_diff = shortcuts - len(out[node]) - len(inc[node])
+        return 2 * edge_diff + contracted_neighbours[node] + level[node]
+
+    @synchronized
+    def build(self):
+        if self.build_time is not None:
+            return
+
+        t_begin = time.perf_counter()
+        n = len(self.nodes)
+
+        out: List[Dict[int, float]] = [{} for _ in range(n)]
+        inc: List[Dict[int, float]] = [{} for _ in range(n)]
+        for i, row in enumerate(self.graph.adjacency(self.metric)):
+            for j, weight in row:
+                if weight < out[i].get(j, INF):
+                    out[i][j] = weight
+                    inc[j][i] = weight
+
+        up: List[Dict[int, float]] = [{} for _ in range(n)]
+        down: List[Dict[int, float]] = [{} for _ in range(n)]
+        rank = [0] * n
+        contracted_neighbours = [0] * n
+        level = [0] * n
+        contracted = [False] * n
+
+        priority = [self._priority(out, inc, i, contracted_neighbours, level) for i in range(n)]
+        heap = [(p, i) for i, p in enumerate(priority)]
+        heapq.heapify(heap)
+
+        order = 0
+        while heap:
+            node_priority, node = heapq.heappop(heap)
+            if contracted[node] or node_priority != priority[node]:
+                continue
+
+            for source, target, weight in self._shortcuts(out, inc, node):
+                if weight < out[source].get(target, INF):
+                    out[source][target] = weight
+                    inc[target][source] = weight
+                    self.mid[(source, target)] = node
+
+            neighbours = out[node].keys() | inc[node].keys()
+            for target, weight in out[node].items():
+                up[node][target] = weight
+                del inc[target][node]
+            for source, weight in inc[node].items():
+                down[node][source] = weight
+                del out[source][node]
+            out[node] = {}
+            inc[node] = {}
+
+            contracted[node] = True
+            rank[node] = order
+            order += 1
+
+            for other in neighbours:
+                contracted_neighbours[other] += 1
+                level[other] = max(level[other], level[node] + 1)
+                priority[other] = self._priority(out, inc, other, contracted_neighbours, level)
+                heapq.heappush(heap, (priority[other], other))
+
+        self.rank = rank
+        self.up = [list(edges.items()) for edges in up]
+        self.down = [list(edges.items()) for edges in down]
+        self.build_time = time.perf_counter() - t_begin
+
+    def _reset(self):
+        self.rank = []
+        self.up = []
+        self.down = []
+        self.mid = {}
+        self.build_time = None
+
+    def _add_node(self, node: GeoNode):
+        self.index[node] = len(self.nodes)
+        self.nodes.append(node)
+        self._reset()
+
+    def _repair_trees(self, u: int, v: int, old: float, new: float):
+        self._reset()
+
+    @synchronized
+    def find_routes(self, node: GeoNode):
+        self.build()
+
+    def _query(self, source: int, target: int, unpack=True) -> Tuple[float, List[int]]:
+        self.build()
+        if source == target:
+            return 0.0, [source]
+
+        dist = ({source: 0.0}, {target: 0.0})
+        pred = ({source: -1}, {target: -1})
+        heaps = ([(0.0, source)], [(0.0, target)])
+        edges = (self.up, self.down)
+
+        best, meet = INF, -1
+        while heaps[0] or heaps[1]:
+            for side in (0, 1):
+                heap = heaps[side]
+                if not heap:
+                    continue
+
+                current_dist, current = heapq.heappop(heap)
+                if current_dist > dist[side][current] or current_dist >= best:
+                    continue
+
+                if current in dist[1 - side] and current_dist + dist[1 - side][current] < best:
+                    best = current_dist + dist[1 - side][current]
+                    meet = current
+
+                for other, weight in edges[side][current]:
+                    other_dist = current_dist + weight
+                    if other_dist < dist[side].get(other, INF):
+                        dist[side][other] = other_dist
+                        pred[side][other] = current
+                        heapq.heappush(heap, (other_dist, other))
+
+            top = min(heap[0][0] if heap else INF for heap in heaps)
+            if top >= best:
+                break
+
+        if meet == -1:
+            return INF, []
+        if not unpack:
+            return best, []
+
+        forward = []
+        current = meet
+        while current != -1:
+            forward.append(current)
+            current = pred[0][current]
+        forward.reverse()
+
+        backward = []
+        current = pred[1][meet]
+        while current != -1:
+            backward.append(current)
+            current = pred[1][current]
+
+        return best, self._unpack(forward + backward)
+
+    def _unpack(self, path: List[int]) -> List[int]:
+        unpacked = [path[0]]
+        stack = list(zip(path[:-1], path[1:]))[::-1]
+        while stack:
+            u, v = stack.pop()
+            if (u, v) in self.mid:
+                node = self.mid[(u, v)]
+                stack.append((node, v))
+                stack.append((u, node))
+            else:
+                unpacked.append(v)
+        return unpacked
+
+    @synchronized
+    def path(self, from_node: GeoNode, to_node: GeoNode) -> List[GeoNode]:
+        dist, path = self._query(self.index[from_node], self.index[to_node])
+        if dist == INF:
+            raise Exception(f'No route from {from_node} to {to_node}')
+        return [self.nodes[i] for i in path]
+
+    @synchronized
+    def dist(self, from_node: GeoNode, to_node: GeoNode) -> float:
+        return self._query(self.index[from_node], self.index[to_node], unpack=False)[0]
+
+    @synchronized
+    def route(self, from_node: GeoNode, to_node: GeoNode) -> Route:
+        return Route(*self.path(from_node, to_node), metric=self.metric)
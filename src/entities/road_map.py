@@ -1,53 +1,521 @@
-import queue
-from typing import Dict, Tuple
+import functools
+import hashlib
+import heapq
+import math
+import os
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Tuple, Type
+
+import numpy as np
+from scipy.sparse.csgraph import shortest_path
 
 from .nodes import GeoNode
-from .route import Route
+from .road_graph import RoadGraph
+from .route import Route, PathCell
 from .system import TransportSystem
 
+INF = float('inf')
+CACHE_SIZE = 4
+MEMORY_LIMIT = 256 * 2 ** 20
+# bytes of one cached PathCell, counted against memory_limit with the trees
+PATH_CELL_SIZE = 72
+
+
+def synchronized(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def fingerprint(sys: TransportSystem) -> int:
+    return hash(tuple((id(node), id(other), road.dist, road.time)
+                      for node in sys.nodes for other, road in node.linked.items()))
+
 
 class RoadMap():
+    """
+    Shortest paths between the nodes of a system
+
+    Paths are optimal by one road metric ('dist' or 'time'), dist()
+    returns the path length in that metric.
+
+    Searches walk the integer adjacency of a RoadGraph snapshot of the
+    roads, which sync() takes again when the roads change.
+
+    Trees are kept per source as compact distance and predecessor arrays
+    indexed by node position. When they and the path cells of routes
+    handed out outgrow memory_limit bytes, the least recently used trees
+    are evicted. With cache_dir set, computed trees are saved to an .npz
+    file named by the hash of the roads and loaded back by later maps of
+    the same network. When roads change, sync() repairs only the parts
+    of the cached trees that depend on the changed roads. One-off pairs
+    of nodes with known coordinates are searched with A* instead.
+    """
+
     sys: TransportSystem
-    routes: Dict[GeoNode, Dict[GeoNode, Route]]
-    dists: Dict[GeoNode, Dict[GeoNode, float]]
+    nodes: List[GeoNode]
+    index: Dict[GeoNode, int]
+    graph: RoadGraph
+    weights: Dict[Tuple[int, int], float]
+    dists: OrderedDict[GeoNode, array]
+    preds: OrderedDict[GeoNode, array]
+    paths: Dict[GeoNode, Dict[int, PathCell]]
+    scale: float | None
 
-    def __init__(self, sys: TransportSystem):
+    def __init__(self, sys: TransportSystem, memory_limit: int | None = MEMORY_LIMIT, cache_dir: str | None = None,
+                 metric: str = 'dist'):
+        self.lock = threading.RLock()
+        self.metric = metric
+        self.memory_limit = memory_limit
+        self.cache_dir = cache_dir
+        self.unsaved = False
         self.sys = sys
-        self.routes = {}
-        self.dists = {}
+        self.nodes = list(sys.nodes)
+        self.index = {node: i for i, node in enumerate(self.nodes)}
+        self.graph = RoadGraph(self.nodes)
+        self.weights = self._road_weights()
+        self.scale = self._heuristic_scale()
+        self.dists = OrderedDict()
+        self.preds = OrderedDict()
+        self.paths = {}
+        self.load()
+
+    def _road_weights(self) -> Dict[Tuple[int, int], float]:
+        return {(i, j): weight for i, row in enumerate(self.graph.adjacency(self.metric)) for j, weight in row}
 
+    def _heuristic_scale(self) -> float | None:
+        """
+        Largest factor k such that k * |pos1 - pos2| never exceeds a road length
+
+        None when some node has no coordinates, then A* is not used.
+        """
+
+        if any(node.pos is None for node in self.nodes):
+            return None
+
+        scale = INF
+        for (i, j), dist in self.weights.items():
+            line = math.dist(self.nodes[i].pos, self.nodes[j].pos)
+            if line > 0:
+                scale = min(scale, dist / line)
+        return 0.0 if scale == INF else scale * (1 - 1e-9)
+
+    def _propagate(self, dist: array, pred: array, heap: List[Tuple[float, int]]):
+        adjacency = self.graph.adjacency(self.metric)
+        while heap:
+            current_dist, current = heapq.heappop(heap)
+            if current_dist > dist[current]:
+                continue
+
+            for other, weight in adjacency[current]:
+                other_dist = current_dist + weight
+                if other_dist < dist[other]:
+                    dist[other] = other_dist
+                    pred[other] = current
+                    heapq.heappush(heap, (other_dist, other))
+
+    @synchronized
     def find_routes(self, node: GeoNode):
-        if node in self.routes:
+        if node in self.dists:
+            self.dists.move_to_end(node)
+            self.preds.move_to_end(node)
+            return
+
+        dist = array('d', [INF]) * len(self.nodes)
+        pred = array('i', [-1]) * len(self.nodes)
+
+        source = self.index[node]
+        dist[source] = 0.0
+        self._propagate(dist, pred, [(0.0, source)])
+
+        self.dists[node] = dist
+        self.preds[node] = pred
+        self.unsaved = True
+        self._evict()
+
+    @property
+    def tree_size(self) -> int:
+        return len(self.nodes) * (array('d').itemsize + array('i').itemsize)
+
+    @property
+    def memory_size(self) -> int:
+        cells = sum(len(cells) for cells in self.paths.values())
+        return len(self.dists) * self.tree_size + cells * PATH_CELL_SIZE
+
+    def _evict(self):
+        if self.memory_limit is None:
             return
 
-        self.routes[node] = {}
-        self.dists[node] = {}
+        while len(self.dists) > 1 and self.memory_size > self.memory_limit:
+            source, _ = self.dists.popitem(last=False)
+            self.preds.popitem(last=False)
+            self.paths.pop(source, None)
+        if self.memory_size > self.memory_limit:
+            self.paths.clear()
 
-        q: queue.Queue[Tuple[float, Route]] = queue.Queue()
-        q.put((0, Route(node)))
+    def _a_star(self, source: int, target: int) -> List[int]:
+        adjacency = self.graph.adjacency(self.metric)
+        scale = self.scale
+        target_pos = self.nodes[target].pos
 
-        while not q.empty():
-            dist, route = q.get()
-            current = route.tail
+        dist = {source: 0.0}
+        pred = {source: -1}
+        settled = set()
+        heap = [(scale * math.dist(self.nodes[source].pos, target_pos), source)]
 
-            if self.dists[node].get(current, 1e+100) <= dist:
+        while heap:
+            _, current = heapq.heappop(heap)
+            if current == target:
+                break
+            if current in settled:
                 continue
+            settled.add(current)
+
+            current_dist = dist[current]
+            for other, weight in adjacency[current]:
+                other_dist = current_dist + weight
+                if other_dist < dist.get(other, INF):
+                    dist[other] = other_dist
+                    pred[other] = current
+                    heapq.heappush(heap, (other_dist + scale * math.dist(self.nodes[other].pos, target_pos), other))
+        else:
+            return []
+
+        path = []
+        current = target
+        while current != -1:
+            path.append(current)
+            current = pred[current]
+        path.reverse()
+        return path
+
+    def _add_node(self, node: GeoNode):
+        self.index[node] = len(self.nodes)
+        self.nodes.append(node)
+        if node.pos is None:
+            self.scale = None
+        for source in self.dists:
+            self.dists[source].append(INF)
+            self.preds[source].append(-1)
+
+    def _subtree(self, pred: array, root: int) -> List[int]:
+        children: List[List[int]] = [[] for _ in pred]
+        for node, parent in enumerate(pred):
+            if parent != -1:
+                children[parent].append(node)
+
+        subtree = [root]
+        for node in subtree:
+            subtree += children[node]
+        return subtree
+
+    def _repair(self, dist: array, pred: array, u: int, v: int, old: float, new: float):
+        if pred[v] == u and new > old:
+            affected = self._subtree(pred, v)
+            for node in affected:
+                dist[node] = INF
+                pred[node] = -1
+
+            incoming = self.graph.adjacency(self.metric, reverse=True)
+            heap = []
+            for node in affected:
+                for other, weight in incoming[node]:
+                    if dist[other] + weight < dist[node]:
+                        dist[node] = dist[other] + weight
+                        pred[node] = other
+                if dist[node] != INF:
+                    heap.append((dist[node], node))
+
+            heapq.heapify(heap)
+            self._propagate(dist, pred, heap)
+        elif dist[u] + new < dist[v]:
+            dist[v] = dist[u] + new
+            pred[v] = u
+            self._propagate(dist, pred, [(dist[v], v)])
+
+    def _repair_trees(self, u: int, v: int, old: float, new: float):
+        self.unsaved = True
+        self.paths.clear()
+        for source in self.dists:
+            self._repair(self.dists[source], self.preds[source], u, v, old, new)
+
+    @synchronized
+    def update_road(self, from_node: GeoNode, to_node: GeoNode):
+        for node in (from_node, to_node):
+            if node not in self.index:
+                self._add_node(node)
+
+        self._take_graph()
+        self._update_road(from_node, to_node)
+
+    def _take_graph(self):
+        # path cells carry both lengths, a change of either metric outdates them
+        old, self.graph = self.graph, RoadGraph(self.nodes)
+        if not old.same_roads(self.graph):
+            self.paths.clear()
+
+    def _update_road(self, from_node: GeoNode, to_node: GeoNode):
+        for node, other in ((from_node, to_node), (to_node, from_node)):
+            key = (self.index[node], self.index[other])
+            old = self.weights.get(key, INF)
+            new = node.weight(other, self.metric)
+            new = INF if new is None else new
+            if old == new:
+                continue
+
+            if new == INF:
+                del self.weights[key]
+            else:
+                self.weights[key] = new
+                line = math.dist(node.pos, other.pos) if self.scale is not None else 0
+                if line > 0:
+                    self.scale = min(self.scale, new / line * (1 - 1e-9))
+
+            self._repair_trees(*key, old, new)
+
+    @synchronized
+    def sync(self):
+        """
+        Brings cached trees in line with the current roads of the system
+        """
+
+        nodes = self.sys.nodes
+        for node in nodes:
+            if node not in self.index:
+                self._add_node(node)
+
+        self._take_graph()
+        weights = self._road_weights()
+        changed = {tuple(sorted(key)) for key in weights.keys() | self.weights.keys()
+                   if weights.get(key) != self.weights.get(key)}
+        for i, j in sorted(changed):
+            self._update_road(self.nodes[i], self.nodes[j])
 
-            self.dists[node][current] = dist
-            self.routes[node][current] = route
+        present = set(nodes)
+        for source in list(self.dists):
+            if source not in present:
+                del self.dists[source]
+                del self.preds[source]
+                self.paths.pop(source, None)
 
-            for other in current.linked:
-                other_dist = dist + current.dist(other)
+    def roads_hash(self) -> str:
+        data = repr((self.metric, len(self.nodes), sorted(self.weights.items())))
+        return hashlib.sha1(data.encode()).hexdigest()
 
-                if self.dists[node].get(other, 1e+100) > other_dist:
-                    other_route = route.extend(other)
-                    q.put((other_dist, other_route))
+    @property
+    def cache_file(self) -> str:
+        return os.path.join(self.cache_dir, f'{type(self).__name__}_{self.roads_hash()}.npz')
 
+    def _trees(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        sources = np.array([self.index[node] for node in self.dists], dtype=np.int32)
+        dists = np.array([np.frombuffer(dist, dtype=np.float64) for dist in self.dists.values()])
+        preds = np.array([np.frombuffer(pred, dtype=np.int32) for pred in self.preds.values()])
+        return sources, dists, preds
+
+    def _load_trees(self, sources: np.ndarray, dists: np.ndarray, preds: np.ndarray):
+        for source, dist, pred in zip(sources, dists, preds):
+            node = self.nodes[source]
+            self.dists[node] = array('d', dist.astype(np.float64).tobytes())
+            self.preds[node] = array('i', pred.astype(np.int32).tobytes())
+            self.paths.pop(node, None)
+        self._evict()
+
+    @synchronized
+    def load(self) -> bool:
+        if self.cache_dir is None or not os.path.exists(self.cache_file):
+            return False
+
+        with np.load(self.cache_file) as data:
+            self._load_trees(data['sources'], data['dists'], data['preds'])
+        self.unsaved = False
+        return True
+
+    @synchronized
+    def save(self):
+        if self.cache_dir is None or not self.unsaved or not self.dists:
+            return
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        sources, dists, preds = self._trees()
+        tmp_file = self.cache_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, sources=sources, dists=dists, preds=preds)
+        os.replace(tmp_file, self.cache_file)
+        self.unsaved = False
+
+    @synchronized
+    def path(self, from_node: GeoNode, to_node: GeoNode) -> List[GeoNode]:
+        self.find_routes(from_node)
+
+        pred = self.preds[from_node]
+        current = self.index[to_node]
+        if self.dists[from_node][current] == INF:
+            raise Exception(f'No route from {from_node} to {to_node}')
+
+        path = []
+        while current != -1:
+            path.append(self.nodes[current])
+            current = pred[current]
+        path.reverse()
+        return path
+
+    def _path_cell(self, source: GeoNode, target: int) -> PathCell:
+        """
+        Path cells of a tree are built once and shared by all its routes
+        """
+
+        cells = self.paths.setdefault(source, {})
+        pred = self.preds[source]
+
+        chain = []
+        current = target
+        while current != -1 and current not in cells:
+            chain.append(current)
+            current = pred[current]
+
+        cell = cells.get(current)
+        for i in reversed(chain):
+            cell = PathCell(self.nodes[i], cell)
+            cells[i] = cell
+        if chain:
+            self._evict()
+        return cell
+
+    @synchronized
+    def dist(self, from_node: GeoNode, to_node: GeoNode) -> float:
+        if from_node not in self.dists and to_node in self.dists:
+            self.find_routes(to_node)
+            return self.dists[to_node][self.index[from_node]]
+
+        self.find_routes(from_node)
+        return self.dists[from_node][self.index[to_node]]
+
+    @synchronized
     def route(self, from_node: GeoNode, to_node: GeoNode) -> Route:
-        if from_node in self.routes:
-            return self.routes[from_node][to_node]
-        elif to_node in self.routes and from_node in self.routes[to_node]:
-            return self.routes[to_node][from_node].inverse()
+        if from_node not in self.dists and to_node in self.dists:
+            path = self.path(to_node, from_node)
+            path.reverse()
+        elif from_node not in self.dists and self.scale is not None:
+            path = self._a_star(self.index[from_node], self.index[to_node])
+            if not path:
+                raise Exception(f'No route from {from_node} to {to_node}')
+            path = [self.nodes[i] for i in path]
         else:
             self.find_routes(from_node)
-            return self.routes[from_node][to_node]
+            if self.dists[from_node][self.index[to_node]] == INF:
+                raise Exception(f'No route from {from_node} to {to_node}')
+            return Route.from_path(self._path_cell(from_node, self.index[to_node]), metric=self.metric)
+        return Route(*path, metric=self.metric)
+
+
+class MatrixRoadMap(RoadMap):
+    dist_matrix: np.ndarray | None
+    pred_matrix: np.ndarray | None
+
+    def __init__(self, sys: TransportSystem, dtype=np.float64, cache_dir: str | None = None, metric: str = 'dist'):
+        self.dtype = dtype
+        self.dist_matrix = None
+        self.pred_matrix = None
+        super(MatrixRoadMap, self).__init__(sys, memory_limit=None, cache_dir=cache_dir, metric=metric)
+
+    @synchronized
+    def build(self):
+        if self.dist_matrix is not None:
+            return
+
+        dist, pred = shortest_path(self.graph.matrix(self.metric), method='D', directed=True, return_predecessors=True)
+        pred[pred < 0] = -1
+
+        self._load_trees(np.arange(len(self.nodes)), dist, pred)
+        self.unsaved = True
+
+    def _trees(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        return np.arange(len(self.nodes), dtype=np.int32), self.dist_matrix, self.pred_matrix
+
+    def _load_trees(self, sources: np.ndarray, dists: np.ndarray, preds: np.ndarray):
+        self.dist_matrix = dists.astype(self.dtype)
+        self.pred_matrix = preds.astype(np.int32)
+        self.paths = {}
+        for i, node in enumerate(self.nodes):
+            self.dists[node] = self.dist_matrix[i]
+            self.preds[node] = self.pred_matrix[i]
+
+    def _heuristic_scale(self) -> float | None:
+        return None
+
+    def _reset(self):
+        self.dist_matrix = None
+        self.pred_matrix = None
+        self.dists = OrderedDict()
+        self.preds = OrderedDict()
+        self.paths = {}
+
+    def _add_node(self, node: GeoNode):
+        self.index[node] = len(self.nodes)
+        self.nodes.append(node)
+        self._reset()
+
+    def _repair_trees(self, u: int, v: int, old: float, new: float):
+        self._reset()
+        self.unsaved = False
+
+    @synchronized
+    def find_routes(self, node: GeoNode):
+        self.build()
+
+    @synchronized
+    def dist(self, from_node: GeoNode, to_node: GeoNode) -> float:
+        self.build()
+        return float(self.dist_matrix[self.index[from_node], self.index[to_node]])
+
+
+class RoadMapCache(object):
+    """
+    Road maps shared between route builders
+
+    Maps are looked up by the fingerprint of the system roads. A map of
+    the same system built for other roads is synced and reused, so its
+    trees are only repaired where the roads actually changed.
+    """
+
+    maps: OrderedDict[Tuple[Type[RoadMap], str, int], RoadMap]
+
+    def __init__(self, size: int = CACHE_SIZE, cache_dir: str | None = None):
+        self.lock = threading.Lock()
+        self.size = size
+        self.cache_dir = cache_dir
+        self.maps = OrderedDict()
+
+    def get(self, sys: TransportSystem, map_type: Type[RoadMap] = RoadMap, metric: str = 'dist') -> RoadMap:
+        key = (map_type, metric, fingerprint(sys))
+
+        with self.lock:
+            if key in self.maps:
+                self.maps.move_to_end(key)
+                return self.maps[key]
+
+            for old_key, road_map in self.maps.items():
+                if road_map.sys is sys and old_key[:2] == key[:2]:
+                    del self.maps[old_key]
+                    road_map.sync()
+                    break
+            else:
+                road_map = map_type(sys, cache_dir=self.cache_dir, metric=metric)
+
+            self.maps[key] = road_map
+            while len(self.maps) > self.size:
+                self.maps.popitem(last=False)
+
+        return road_map
+
+    def clear(self):
+        with self.lock:
+            self.maps.clear()
+
+
+shared_maps = RoadMapCache()
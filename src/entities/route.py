@@ -1,49 +1,237 @@
+import weakref
+from collections import defaultdict
 from copy import copy, deepcopy
-from typing import List, Set, Dict
+from typing import List, Set, Dict, Any, Optional, Tuple
+
+import numpy as np
 
 from . import Consumer, LinkedRoad
 from .nodes import GeoNode, Warehouse
+from .road_graph import RoadGraph
 from .product import ProductList
 from .road import Road
 from .transport import Transport
 
 
+class PathCell(object):
+    """
+    Immutable cell of a route path pointing to the previous cell
+
+    Paths grown from the same cell share it, so routes with a common
+    prefix keep one copy of it. Every cell carries the path length up
+    to its node.
+    """
+
+    __slots__ = ('node', 'parent', 'size', 'dist', 'time')
+    node: GeoNode
+    parent: Optional['PathCell']
+    size: int
+    dist: float
+    time: float
+
+    def __init__(self, node: GeoNode, parent: 'PathCell' = None):
+        self.node = node
+        self.parent = parent
+        if parent is None:
+            self.size, self.dist, self.time = 1, 0.0, 0.0
+        else:
+            road = parent.node.linked[node]
+            self.size = parent.size + 1
+            self.dist = parent.dist + road.dist
+            self.time = parent.time + road.time
+
+    @staticmethod
+    def from_nodes(nodes: List[GeoNode]) -> 'PathCell':
+        cell = None
+        for node in nodes:
+            cell = PathCell(node, cell)
+        return cell
+
+    def cells(self) -> List['PathCell']:
+        cells = []
+        cell = self
+        while cell is not None:
+            cells.append(cell)
+            cell = cell.parent
+        cells.reverse()
+        return cells
+
+    def nodes(self) -> List[GeoNode]:
+        return [cell.node for cell in self.cells()]
+
+
 class Route:
-    nodes: List[GeoNode]
+    """
+    Path through the nodes with the loads handled at every node
+
+    The geometry is a PathCell chain shared with the routes it was copied
+    from, nodes is materialized from it on demand. Loads are stored only
+    for the stops that handle products, keyed by stop index. Values that
+    depend on loads are cached in _derived until the loads change. Change
+    nodes, loads and track through the methods only, they also mark the
+    route stale in the RouteLists holding columns for it.
+    """
+
+    __slots__ = ('track', 'metric', '_path', '_nodes', '_loads', '_derived', '_lists')
     track: Transport | None
-    loads: List[ProductList]
-
-    def __init__(self, node: GeoNode, *nodes: GeoNode):
+    metric: str
+    _path: PathCell
+    _nodes: Optional[List[GeoNode]]
+    _loads: Dict[int, ProductList]
+    _derived: Dict[str, Any]
+    _lists: Optional[List[weakref.ref]]
+
+    def __init__(self, node: GeoNode, *nodes: GeoNode, metric='dist'):
         self.track = None
-        self.nodes = [node]
-        self.loads = [ProductList()]
+        self.metric = metric
+        self._path = PathCell(node)
+        self._nodes = None
+        self._loads = {}
+        self._derived = {}
+        self._lists = None
 
         for node in nodes:
             self.add_node(node)
 
+    @classmethod
+    def from_path(cls, path: PathCell, metric='dist', loads: Dict[int, ProductList] = None) -> 'Route':
+        route = cls.__new__(cls)
+        route.track = None
+        route.metric = metric
+        route._path = path
+        route._nodes = None
+        route._loads = {} if loads is None else loads
+        route._derived = {}
+        route._lists = None
+        return route
+
+    @classmethod
+    def from_ids(cls, ids: np.ndarray, graph: RoadGraph, metric='dist',
+                 loads: Dict[int, ProductList] = None) -> 'Route':
+        route = cls(*graph.decode(ids), metric=metric)
+        if loads is not None:
+            route._loads = loads
+        return route
+
+    def ids(self, graph: RoadGraph) -> np.ndarray:
+        """
+        Positions of the route nodes in graph, cost of the array is graph.cost
+        """
+
+        return graph.encode(self.nodes)
+
     def __copy__(self) -> 'Route':
-        new_route = Route(*self.nodes)
-        new_route.loads = deepcopy(self.loads)
+        new_route = Route.from_path(self._path, self.metric, deepcopy(self._loads))
         new_route.track = self.track
+        if self._nodes is not None:
+            new_route._nodes = list(self._nodes)
+        new_route._derived = dict(self._derived)
         return new_route
 
     def __repr__(self) -> str:
         s = ' -> '.join(map(str, self.nodes))
         return s
 
+    @property
+    def nodes(self) -> List[GeoNode]:
+        if self._nodes is None:
+            self._nodes = self._path.nodes()
+        return self._nodes
+
+    @nodes.setter
+    def nodes(self, nodes: List[GeoNode]):
+        self._path = PathCell.from_nodes(nodes)
+        self._nodes = None
+        self._changed()
+
+    @property
+    def path(self) -> PathCell:
+        return self._path
+
+    @property
+    def loads(self) -> List[ProductList]:
+        """
+        Load of every stop, transit stops get a new empty list
+        """
+
+        return [self.load(i) for i in range(self._path.size)]
+
+    @loads.setter
+    def loads(self, loads: List[ProductList]):
+        self._loads = {i: load for i, load in enumerate(loads) if load}
+        self._changed()
+
+    def load(self, index: int) -> ProductList:
+        if index < 0:
+            index += self._path.size
+        return self._loads[index] if index in self._loads else ProductList()
+
+    def _stop(self, index: int) -> ProductList:
+        # load of the stop, stored so that it can be changed in place
+        if index not in self._loads:
+            self._loads[index] = ProductList()
+        return self._loads[index]
+
+    @property
+    def deliveries(self) -> List[Tuple[int, ProductList]]:
+        return sorted(self._loads.items())
+
+    def _reversed_stops(self):
+        nodes = self.nodes
+        for i in range(len(nodes) - 1, -1, -1):
+            yield nodes[i], self._stop(i)
+
+    def _push(self, node: GeoNode, load: ProductList):
+        self._path = PathCell(node, self._path)
+        if self._nodes is not None:
+            self._nodes.append(node)
+        if load:
+            self._loads[self._path.size - 1] = load
+        self._changed()
+
+    def _pop(self):
+        self._loads.pop(self._path.size - 1, None)
+        self._path = self._path.parent
+        if self._nodes is not None:
+            self._nodes.pop()
+        self._changed()
+
+    def _changed(self):
+        self._derived.clear()
+        self._mark_stale()
+
+    def _mark_stale(self):
+        if self._lists:
+            for ref in self._lists:
+                routes = ref()
+                if routes is not None:
+                    routes._stale(self)
+
+    def _listed(self, routes: 'RouteList'):
+        # routes holds a row for this route, dead lists are dropped here
+        lists = [ref for ref in self._lists or () if ref() is not None and ref() is not routes]
+        lists.append(weakref.ref(routes))
+        self._lists = lists
+
+    def _cached(self, key: str, func):
+        if key not in self._derived:
+            self._derived[key] = func()
+        return self._derived[key]
+
     def add_node(self, node: GeoNode):
         if self.tail.is_linked(node):
-            self.nodes.append(node)
-            self.loads.append(ProductList())
+            self._push(node, ProductList())
         else:
             raise Exception('No road for next node')
 
     def set_track(self, track: Transport):
         self.track = track
+        self._mark_stale()
 
     def set_load(self, node: GeoNode, load: ProductList):
         i = len(self.nodes) - 1 - self.nodes[::-1].index(node)
-        self.loads[i] = load
+        self._loads[i] = load
+        self._changed()
 
     def extend(self, node: GeoNode) -> 'Route':
         new = copy(self)
@@ -52,25 +240,30 @@ class Route:
 
     def prolong(self, other: 'Route'):
         offset = 1 if self.tail == other.head else 0
-        self.nodes += other.nodes[offset:]
-        self.loads += other.loads[offset:]
+        for i, node in enumerate(other.nodes[offset:], offset):
+            self._push(node, other._loads.get(i))
 
     def inverse(self) -> 'Route':
         new = copy(self)
+        last = len(new.nodes) - 1
         new.nodes = new.nodes[::-1]
-        new.loads = new.loads[::-1]
+        new._loads = {last - i: load for i, load in new._loads.items()}
         return new
 
+    def length(self, metric: str) -> float:
+        return getattr(self._path, metric)
+
     @property
     def dist(self) -> float:
-        d = 0.0
-        for node_form, node_to in zip(self.nodes[:-1], self.nodes[1:]):
-            d += node_form.dist(node_to)
-        return d
+        return self.length('dist')
+
+    @property
+    def time(self) -> float:
+        return self.length('time')
 
     @property
     def cost(self) -> float:
-        return self.dist
+        return self.length(self.metric)
 
     @property
     def roads(self) -> List[Road]:
@@ -101,7 +294,7 @@ class Route:
 
     @property
     def volume(self) -> float:
-        return sum(prod.sum_volume for prod in self.products)
+        return self._cached('volume', lambda: sum(prod.sum_volume for prod in self.products))
 
     @property
     def free_volume(self) -> float:
@@ -126,25 +319,24 @@ class Route:
 
     @property
     def prod_names(self) -> Set[str]:
-        names: Set[str] = set()
-        for load in self.loads:
-            for prod in load:
-                names.add(prod.name)
-        return names
+        return self._cached('prod_names', lambda: {prod.name for load in self._loads.values() for prod in load})
 
     @property
     def warehouse(self) -> Warehouse:
-        return self.find_warehouse(empty_route=False)
+        return self._cached('warehouse', lambda: self.find_warehouse(empty_route=False))
 
     @property
     def last_delivery(self) -> int:
-        for index, load in enumerate(reversed(self.loads)):
-            if load: return len(self.nodes) - 1 - index
+        return self._cached('last_delivery', self._last_delivery)
+
+    def _last_delivery(self) -> int:
+        return max((index for index, load in self._loads.items() if load), default=None)
 
     def find_warehouse(self, empty_route=False):
-        for node, load in zip(self.nodes[::-1], self.loads[::-1]):
-            if isinstance(node, Warehouse) and (not load.is_empty() or empty_route):
-                return node
+        nodes = self.nodes
+        for i in range(len(nodes) - 1, -1, -1):
+            if isinstance(nodes[i], Warehouse) and (empty_route or self._loads.get(i)):
+                return nodes[i]
 
     @property
     def head(self) -> GeoNode:
@@ -152,7 +344,7 @@ class Route:
 
     @property
     def tail(self) -> GeoNode:
-        return self.nodes[-1]
+        return self._path.node
 
     @property
     def ctail(self) -> Consumer:
@@ -162,44 +354,41 @@ class Route:
 
     @property
     def products(self) -> ProductList:
-        index = self.nodes.index(self.warehouse)
-        return self.loads[index]
+        index = self._cached('products_index', lambda: self.nodes.index(self.warehouse))
+        return self._stop(index)
+
+    def node_length(self, metric: str) -> Dict[GeoNode, float]:
+        return {cell.node: getattr(cell, metric) for cell in self._path.cells()}
 
     @property
     def node_dist(self) -> Dict[GeoNode, float]:
-        dist = 0.0
-        dist_dict = {self.nodes[0]: dist}
-
-        for node_form, node_to in zip(self.nodes[:-1], self.nodes[1:]):
-            road = node_form.linked[node_to]
-            dist += road.dist
-            dist_dict[node_to] = dist
+        return self.node_length('dist')
 
-        return dist_dict
+    @property
+    def node_cost(self) -> Dict[GeoNode, float]:
+        return self.node_length(self.metric)
 
     def _take_over_same(self, other: 'Route') -> bool:
         other_warehouse = other.warehouse
         other_warehouse_index = other.nodes.index(other_warehouse)
         warehouse_index = self.nodes.index(self.warehouse)
 
-        for node, load in zip(other.nodes[::-1], other.loads[::-1]):
-            if not other.loads[other_warehouse_index].amount:
+        for node, load in other._reversed_stops():
+            if not other._stop(other_warehouse_index).amount:
                 return True
 
             transit = copy(load)
             rem = transit.to_restriction(self.free_volume)
 
-            self.nodes.append(node)
-            self.loads.append(transit)
-            self.loads[warehouse_index].add(transit)
-            other.loads[other_warehouse_index].minus(transit)
+            self._push(node, transit)
+            self._stop(warehouse_index).add(transit)
+            other._stop(other_warehouse_index).minus(transit)
 
             if rem.amount:
-                other.loads[-1] = rem
+                other._loads[len(other.nodes) - 1] = rem
                 return False
             else:
-                other.nodes.pop()
-                other.loads.pop()
+                other._pop()
                 return True
 
         return True
@@ -209,8 +398,8 @@ class Route:
         other_warehouse = other.warehouse
         other_warehouse_index = other.nodes.index(other_warehouse)
 
-        for node, load in zip(other.nodes[::-1], other.loads[::-1]):
-            if not other.loads[other_warehouse_index].amount:
+        for node, load in other._reversed_stops():
+            if not other._stop(other_warehouse_index).amount:
                 return True
 
             transit = load.from_balance(self.warehouse)
@@ -221,53 +410,243 @@ class Route:
             rem.to_balance(self.warehouse)
             transit.to_balance(other_warehouse)
 
-            self.nodes.append(node)
-            self.loads.append(transit)
-            self.loads[warehouse_index].add(transit)
-            other.loads[other_warehouse_index].minus(transit)
+            self._push(node, transit)
+            self._stop(warehouse_index).add(transit)
+            other._stop(other_warehouse_index).minus(transit)
 
             if load.amount:
                 return False
             else:
-                other.nodes.pop()
-                other.loads.pop()
+                other._pop()
                 return True
 
         return True
 
-    def take_over(self, other: 'Route') -> bool:
+    def take_over(self, other: 'Route', journal: 'RouteJournal' = None) -> Tuple[bool, float]:
+        """
+        Returns if the stop was taken over and the change of the cost of
+        both routes made by the stops appended here and removed from other
+        """
+
         if not self.tail.is_linked(other.tail):
-            return False
+            return False, 0.0
+
+        if journal is not None:
+            journal.touch(self)
+            journal.touch(other)
 
+        cost = self.cost + other.cost
         if self.warehouse == other.warehouse:
-            return self._take_over_same(other)
+            taken = self._take_over_same(other)
         else:
-            return self._take_over_diff(other)
+            taken = self._take_over_diff(other)
+
+        # loads of both routes were changed in place
+        self._changed()
+        other._changed()
+        return taken, self.cost + other.cost - cost
 
     def rollback(self, other: 'Route'):
-        self.nodes = other.nodes
-        self.loads = other.loads
+        self._path = other._path
+        self._nodes = other._nodes
+        self._loads = other._loads
         self.track = other.track
+        self._derived = other._derived
+        self._mark_stale()
+
+
+class RouteJournal(list[Tuple[Route, Route]]):
+    """
+    Undo log of route edits
+
+    A route is copied when it is first changed after the latest savepoint,
+    rolling back restores only the copied routes, so its cost depends on
+    the routes touched and not on the plan size.
+    """
+
+    recorded: Dict[Route, int]
+    start: int
+
+    def __init__(self):
+        super(RouteJournal, self).__init__()
+        self.recorded = {}
+        self.start = 0
+
+    def touch(self, route: Route):
+        if self.recorded.get(route, -1) >= self.start:
+            return
+
+        self.recorded[route] = len(self)
+        self.append((route, copy(route)))
+
+    def savepoint(self) -> int:
+        self.start = len(self)
+        return self.start
+
+    def rollback(self, savepoint: int) -> List[Route]:
+        restored = []
+        while len(self) > savepoint:
+            route, saved = self.pop()
+            route.rollback(saved)
+            self.recorded.pop(route, None)
+            restored.append(route)
+        self.start = savepoint
+        return restored
 
 
 class RouteList(list[Route]):
+    """
+    Routes of a plan with per route columns for plan queries
+
+    Tail id, cost, volume, capacity, occupancy and fullness of every route
+    are kept in numpy columns next to a tail -> rows index. They are built
+    on the first query after the list itself changes. Routes changed in
+    place mark their rows stale, the next query refreshes only those rows.
+    """
+
+    _columns: Optional[Dict[str, np.ndarray]] = None
+    _stale_routes: Dict[Route, None]
+    _rows: Dict[Route, int]
+    _by_tail: Dict[GeoNode, Set[int]]
+    _tail_ids: Dict[GeoNode, int]
+    _tails: List[GeoNode]
+
     def __copy__(self) -> 'RouteList':
         new = RouteList()
         for route in self:
             new.append(copy(route))
         return new
 
+    def _build(self):
+        self._rows = {route: i for i, route in enumerate(self)}
+        self._by_tail = defaultdict(set)
+        self._tail_ids = {}
+        self._tails = []
+        self._stale_routes = {}
+        self._columns = {
+            'tail': np.zeros(len(self), dtype=np.int64),
+            'cost': np.zeros(len(self), dtype=np.float64),
+            'volume': np.zeros(len(self), dtype=np.float64),
+            'capacity': np.zeros(len(self), dtype=np.float64),
+            'occupancy': np.zeros(len(self), dtype=np.float64),
+            'full': np.zeros(len(self), dtype=bool),
+        }
+        for i, route in enumerate(self):
+            route._listed(self)
+            self._set_row(i, route)
+
+    def _set_row(self, i: int, route: Route):
+        tail = route.tail
+        self._by_tail[tail].add(i)
+        if tail not in self._tail_ids:
+            self._tail_ids[tail] = len(self._tails)
+            self._tails.append(tail)
+
+        columns = self._columns
+        columns['tail'][i] = self._tail_ids[tail]
+        columns['cost'][i] = route.cost
+        if route.track is None:
+            columns['volume'][i] = columns['capacity'][i] = columns['occupancy'][i] = np.nan
+            columns['full'][i] = False
+        elif route.warehouse is None:
+            columns['volume'][i] = columns['occupancy'][i] = 0.0
+            columns['capacity'][i] = route.track.volume
+            columns['full'][i] = False
+        else:
+            columns['volume'][i] = route.volume
+            columns['capacity'][i] = route.track.volume
+            columns['occupancy'][i] = route.occupancy
+            columns['full'][i] = route.is_full
+
+    def column(self, name: str) -> np.ndarray:
+        if self._columns is None:
+            self._build()
+        elif self._stale_routes:
+            self.refresh(*self._stale_routes)
+        return self._columns[name]
+
+    def _stale(self, route: Route):
+        if self._columns is not None:
+            self._stale_routes[route] = None
+
+    def refresh(self, *routes: Route):
+        if self._columns is None:
+            return
+
+        for route in routes:
+            self._stale_routes.pop(route, None)
+            i = self._rows.get(route)
+            if i is None:
+                continue
+
+            self._by_tail[self._tails[self._columns['tail'][i]]].discard(i)
+            self._set_row(i, route)
+
+    def _changed(self):
+        self._columns = None
+
+    def append(self, route: Route):
+        super(RouteList, self).append(route)
+        self._changed()
+
+    def extend(self, routes):
+        super(RouteList, self).extend(routes)
+        self._changed()
+
+    def insert(self, index, route: Route):
+        super(RouteList, self).insert(index, route)
+        self._changed()
+
+    def remove(self, route: Route):
+        super(RouteList, self).remove(route)
+        self._changed()
+
+    def pop(self, index=-1) -> Route:
+        self._changed()
+        return super(RouteList, self).pop(index)
+
+    def clear(self):
+        super(RouteList, self).clear()
+        self._changed()
+
+    def sort(self, *args, **kwargs):
+        super(RouteList, self).sort(*args, **kwargs)
+        self._changed()
+
+    def reverse(self):
+        super(RouteList, self).reverse()
+        self._changed()
+
+    def __setitem__(self, index, value):
+        super(RouteList, self).__setitem__(index, value)
+        self._changed()
+
+    def __delitem__(self, index):
+        super(RouteList, self).__delitem__(index)
+        self._changed()
+
+    def __iadd__(self, routes) -> 'RouteList':
+        self._changed()
+        return super(RouteList, self).__iadd__(routes)
+
+    def __imul__(self, n) -> 'RouteList':
+        self._changed()
+        return super(RouteList, self).__imul__(n)
+
+    def _take(self, rows) -> 'RouteList':
+        return RouteList(self[i] for i in rows)
+
     @property
     def blank_routes(self) -> 'RouteList':
-        return RouteList(filter(lambda r: not r.is_full, self))
+        return self._take(np.flatnonzero(~self.column('full')))
 
     @property
     def sort_occupancy(self) -> 'RouteList':
-        return RouteList(sorted(self, key=lambda r: r.occupancy))
+        return self._take(np.argsort(self.column('occupancy'), kind='stable'))
 
     @property
     def cost(self) -> float:
-        return sum(route.cost for route in self)
+        return float(self.column('cost').sum())
 
     @property
     def snapshot(self) -> Dict[Route, Route]:
@@ -277,7 +656,8 @@ class RouteList(list[Route]):
         return old_new
 
     def by_tail(self, tail: GeoNode) -> 'RouteList':
-        return RouteList(filter(lambda r: r.tail == tail, self))
+        self.column('tail')
+        return self._take(sorted(self._by_tail.get(tail, ())))
 
     def rollback(self, snapshot: Dict[Route, Route]):
         for route in self:
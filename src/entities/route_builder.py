@@ -1,113 +1,216 @@
+import bisect
+import time
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, wait
 from copy import copy, deepcopy
-from typing import List, Dict, Tuple
+from typing import List, Dict, Set, Tuple
+
+import numpy as np
 
 from .nodes import Warehouse, Consumer, GeoNode
-from .product import ProductList
-from .road_map import RoadMap
-from .route import Route, RouteList
+from .product import ProductLedger, ProductList
+from .road_graph import RoadGraph
+from .road_map import RoadMap, INF, shared_maps
+from .route import Route, RouteList, RouteJournal
 from .route_shedule import ScheduleBuilder, RouteScheduleList
 from .system import TransportSystem
 import datetime as dt
 
 MAX_ITER = 1_000
+# cost changes below it are rounding of the take-over delta
+COST_EPS = 1e-9
+
+
+class PotentialState(object):
+    """
+    Merged discrepancy of a plan kept between optimization iterations
+
+    Discrepancy of a consumer comes from its nearest consumer neighbour and
+    the largest over products potential, which is the lowest cost to the
+    node over routes carrying the product. Only routes through a node set
+    its value, so update recomputes the nodes of the touched routes and
+    keeps the sorted list by (discrepancy, node index).
+    """
+
+    routes: RouteList
+    graph: RoadGraph
+    metric: str
+    node_routes: Dict[GeoNode, Set[Route]]
+    applied: Dict[Route, Dict[GeoNode, float]]
+    nearest: Dict[GeoNode, Tuple[float, GeoNode] | None]
+    merged: Dict[GeoNode, Tuple[float, int, GeoNode, GeoNode]]
+    order: List[Tuple[float, int, GeoNode, GeoNode]]
+
+    def __init__(self, routes: RouteList, graph: RoadGraph, metric='dist'):
+        self.routes = routes
+        self.graph = graph
+        self.metric = metric
+        self.node_routes = defaultdict(set)
+        self.applied = {}
+        self.nearest = {}
+        self.merged = {}
+        self.order = []
+        self.update(routes)
+
+    def _nearest(self, node: GeoNode) -> Tuple[float, GeoNode] | None:
+        # first closest consumer among the roads leaving a consumer
+        if node not in self.nearest:
+            i = self.graph.index[node]
+            best = None
+            if self.graph.consumers[i]:
+                for other, dist in self.graph.adjacency(self.metric)[i]:
+                    if self.graph.consumers[other] and (best is None or dist < best[0]):
+                        best = (dist, self.graph.nodes[other])
+            self.nearest[node] = best
+        return self.nearest[node]
+
+    def _potential(self, node: GeoNode) -> float | None:
+        pot: Dict[str, float] = {}
+        for route in self.node_routes[node]:
+            cost = self.applied[route][node]
+            for prod in route.prod_names:
+                pot[prod] = min(pot.get(prod, cost), cost)
+        return max(pot.values(), default=None)
 
+    def _refresh(self, node: GeoNode):
+        old = self.merged.pop(node, None)
+        if old is not None:
+            del self.order[bisect.bisect_left(self.order, old)]
 
-def collect_products(*node_products: ProductList) -> ProductList:
-    collapsed_arr = ProductList()
-    for products in node_products:
-        for prod in products:
-            old_prod = list(filter(lambda p: p.name == prod.name, collapsed_arr))
-            if old_prod:
-                old_prod[0] += prod
-            else:
-                collapsed_arr.append(copy(prod))
-    return collapsed_arr
-
-
-def enough_products(stock: ProductList, order: ProductList) -> bool:
-    for prod in order:
-        stock_prods = stock.by_name(prod.name)
-        if stock_prods is None or stock_prods.amount < prod.amount:
-            return False
-    return True
-
-
-class ProductPot(dict[GeoNode, float]):
-    def apply_route(self, route: Route):
-        for node, dist in route.node_dist.items():
-            self[node] = min(self.get(node, dist), dist)
+        nearest = self._nearest(node)
+        pot = self._potential(node) if nearest is not None else None
+        if pot is None or nearest[0] - pot >= 0:
+            return
 
+        new = (nearest[0] - pot, self.graph.index[node], nearest[1], node)
+        self.merged[node] = new
+        bisect.insort(self.order, new)
 
-class ProductDisc(List[Tuple[float, GeoNode, GeoNode]]):
-    # potential, from, to
+    def update(self, routes: List[Route]):
+        """
+        Apply the changes of routes, the ones left out of the plan are dropped
+        """
 
-    def __init__(self, prod: str, pot: ProductPot, routes: List[Route]):
-        super(ProductDisc, self).__init__()
+        changed: Dict[GeoNode, None] = {}
+        for route in routes:
+            for node in self.applied.pop(route, {}):
+                self.node_routes[node].discard(route)
+                changed[node] = None
 
-        self.prod = prod
-        self.pot = pot
+            if route in self.routes:
+                self.applied[route] = route.node_cost
+                for node in self.applied[route]:
+                    self.node_routes[node].add(route)
+                    changed[node] = None
 
-        for node in pot.keys():
-            self._process_node(node)
+        for node in changed:
+            self._refresh(node)
 
-        del self.pot
-
-    def _process_node(self, node: GeoNode):
-        if not isinstance(node, Consumer):
-            return
-
-        node_pot = self.pot[node]
-        for other in node.linked:
-            if not isinstance(other, Consumer):
-                continue
-            dist = node.dist(other)
-            delta = -node_pot + dist
-            if delta < 0:
-                self.append((delta, other, node))
+    @property
+    def discrepancy(self) -> List[Tuple[float, GeoNode, GeoNode]]:
+        return [(delta, from_node, to_node) for delta, _, from_node, to_node in self.order]
 
 
 class RouteBuilder(object):
     sys: TransportSystem
     road_map: RoadMap
-    all_stocks: ProductList
-    all_orders: ProductList
+    metric: str
+    all_stocks: ProductLedger
+    all_orders: ProductLedger
 
-    stocks: Dict[Warehouse, ProductList]
-    orders: Dict[Consumer, ProductList]
+    stocks: Dict[Warehouse, ProductLedger]
+    orders: Dict[Consumer, ProductLedger]
 
     prod_nodes: Dict[str, List[GeoNode]]
+    potentials: PotentialState | None = None
+    multi_move: bool
+    workers: int
+    pass_moves: List[int]
+    phase_times: Dict[str, float]
+    deadline: float | None = None
+    debug: bool = False
+    _pool: ProcessPoolExecutor | None = None
+
+    def __init__(self, sys: TransportSystem, road_map: RoadMap = None, metric: str = 'dist',
+                 multi_move=False, workers=0):
+        """
+        metric selects the cost model of the plan: 'dist' minimizes the
+        length of routes, 'time' minimizes their travel time.
+        multi_move applies all non-conflicting improving moves of a pass
+        before the discrepancy is updated, pass_moves keeps their numbers.
+        workers > 1 scores the moves of a pass in that many processes
+        and applies the best non-conflicting ones
+        """
 
-    def __init__(self, sys: TransportSystem):
         self.sys = sys
-        self.road_map = RoadMap(sys)
+        self.multi_move = multi_move
+        self.workers = workers
+        self.pass_moves = []
+        self.phase_times = {}
+        if road_map is None:
+            road_map = shared_maps.get(sys, metric=metric)
+        else:
+            road_map.sync()
+        self.road_map = road_map
+        self.metric = road_map.metric
 
         sys.check_valid()
         self.init_orders()
 
     def init_orders(self):
-        self.all_stocks = collect_products(*[node.stock for node in self.sys.warehouses])
-        self.all_orders = collect_products(*[node.order for node in self.sys.consumers])
-        if not enough_products(self.all_stocks, self.all_orders):
+        catalog = self.sys.catalog
+        self.all_stocks = ProductLedger.from_products(*[node.stock for node in self.sys.warehouses], catalog=catalog)
+        self.all_orders = ProductLedger.from_products(*[node.order for node in self.sys.consumers], catalog=catalog)
+        if not self.all_stocks.covers(self.all_orders):
             raise Exception('Orders have more products, than stocks are storing')
 
-        self.stocks = {w_node: collect_products(w_node.stock) for w_node in self.sys.warehouses}
-        self.orders = {c_node: collect_products(c_node.order) for c_node in self.sys.consumers}
+        self.stocks = {w_node: ProductLedger.from_products(w_node.stock, catalog=catalog)
+                       for w_node in self.sys.warehouses}
+        self.orders = {c_node: ProductLedger.from_products(c_node.order, catalog=catalog)
+                       for c_node in self.sys.consumers}
 
     def calc_routes(self, iter_limit: int = MAX_ITER,
                     begin: dt.timedelta = dt.timedelta(hours=9),
-                    end: dt.timedelta = dt.timedelta(hours=18)
+                    end: dt.timedelta = dt.timedelta(hours=18),
+                    time_budget: float | None = None
                     ) -> RouteScheduleList:
-        routes = self._min_elem_routes()
-        self.sys.init_balance(routes)
+        """
+        time_budget in seconds stops the optimization when it runs out,
+        the plan found so far is closed and scheduled anyway.
+        phase_times keeps the seconds every phase took
+        """
 
-        routes = self._potential_optimize(routes, iter_limit)
+        t_begin = time.perf_counter()
+        self.deadline = None if time_budget is None else t_begin + time_budget
+        self.phase_times = {}
 
-        routes = self._close_routes(routes)
-        schedule = ScheduleBuilder(self.sys).build_schedule(routes, begin, end)
+        try:
+            routes = self._min_elem_routes()
+            self.sys.init_balance(routes)
+            t_begin = self._phase_done('init', t_begin)
+
+            routes = self._potential_optimize(routes, iter_limit)
+            t_begin = self._phase_done('optimize', t_begin)
+
+            routes = self._close_routes(routes)
+            self.road_map.save()
+            t_begin = self._phase_done('close', t_begin)
+
+            schedule = ScheduleBuilder(self.sys).build_schedule(routes, begin, end)
+            self._phase_done('schedule', t_begin)
+        finally:
+            self.deadline = None
 
         return schedule
 
+    def _phase_done(self, phase: str, t_begin: float) -> float:
+        t_end = time.perf_counter()
+        self.phase_times[phase] = t_end - t_begin
+        return t_end
+
+    def _out_of_time(self) -> bool:
+        return self.deadline is not None and time.perf_counter() >= self.deadline
+
     def stat_calc_routes(self) -> (RouteScheduleList, List):
         routes = self._min_elem_routes()
         self.sys.init_balance(routes)
@@ -117,7 +220,8 @@ class RouteBuilder(object):
 
         avg_dist = sum(r.dist for r in routes) / len(routes)
         avg_full = sum(r.occupancy for r in routes) / len(routes)
-        avg_parking_dist = sum(dist[1].dist for dist in self.road_map.routes[self.sys.parking].items())
+        parking_dists = (self.road_map.dist(self.sys.parking, node) for node in self.sys.nodes)
+        avg_parking_dist = sum(dist for dist in parking_dists if dist != INF)
         stat_list.append({'cost': routes.cost, 'len': len(routes),
                           'avg_dist': avg_dist, 'avg_full': avg_full, 'avg_parking_dist': avg_parking_dist})
 
@@ -126,13 +230,15 @@ class RouteBuilder(object):
 
             avg_dist = sum(r.dist for r in routes) / len(routes)
             avg_full = sum(r.occupancy for r in routes) / len(routes)
-            stat_list.append({'cost': routes.cost, 'len': len(routes), 'avg_dist': avg_dist, 'avg_full': avg_full})
+            stat_list.append({'cost': routes.cost, 'len': len(routes), 'avg_dist': avg_dist, 'avg_full': avg_full,
+                              'moves': upd})
 
             if not upd:
                 break
             print(f'{i} iter')
 
         routes = self._close_routes(routes)
+        self.road_map.save()
         schedule = ScheduleBuilder(self.sys).build_schedule(routes)
 
         return schedule, stat_list
@@ -147,11 +253,11 @@ class RouteBuilder(object):
                     continue
 
                 w_node: Warehouse
-                route = copy(self.road_map.route(self.sys.parking, w_node))
+                route = self.road_map.route(self.sys.parking, w_node)
                 route.prolong(Route(w_node, c_node))
                 all_routes.append(route)
 
-        all_routes.sort(key=lambda route: route.dist)
+        all_routes.sort(key=lambda route: route.cost)
         return all_routes
 
     def _distribute_products(self, all_routes: RouteList):
@@ -164,10 +270,12 @@ class RouteBuilder(object):
 
             stock = self.stocks[w_node]
             order = self.orders[c_node]
-            cross_products = order * stock
-            if cross_products.is_empty():
+            cross = order.cross(stock)
+            if cross.is_empty():
                 continue
 
+            cross_products = cross.to_products()
+
             selected_track = transport[index % len(transport)]
             if cross_products.volume >= selected_track.volume:
                 cross_products.to_restriction(selected_track.volume)
@@ -190,12 +298,12 @@ class RouteBuilder(object):
             for w_node in self.sys.warehouses:
                 if w_node.is_linked(c_node):
                     continue
-                route_w = copy(self.road_map.route(self.sys.parking, w_node))
-                route_c = copy(self.road_map.route(w_node, c_node))
+                route_w = self.road_map.route(self.sys.parking, w_node)
+                route_c = self.road_map.route(w_node, c_node)
                 route_w.prolong(route_c)
                 all_routes.append(route_w)
 
-        all_routes.sort(key=lambda route: route.dist)
+        all_routes.sort(key=lambda route: route.cost)
         return all_routes
 
     def _min_elem_routes(self) -> RouteList:
@@ -209,14 +317,47 @@ class RouteBuilder(object):
 
         return routes
 
-    def _optimization_iteration(self, pre_routes: RouteList) -> bool:
-        pot = self._calculate_potentials(pre_routes)
-        disc = self._calculate_discrepancy(pot, pre_routes)
-        merged_disc = self._merge_discrepancy(disc)
-        pending_routes = pre_routes.blank_routes
+    def _optimization_iteration(self, pre_routes: RouteList) -> int:
+        """
+        Applies take-overs in discrepancy order and returns their number
+
+        The first move lowering the plan cost ends the pass, with multi_move
+        every such move is applied if the routes it touches were not touched
+        by the moves before it in the pass.
+        """
 
-        balance_snapshot = self.sys.balance_snapshot
+        if self.potentials is None or self.potentials.routes is not pre_routes:
+            self.potentials = PotentialState(pre_routes, self.sys.graph, self.metric)
+        if self._pool is not None:
+            return self._parallel_iteration(pre_routes)
+        merged_disc = self.potentials.discrepancy
+
+        self.sys.balance_commit()
+        journal = RouteJournal()
         init_cost = pre_routes.cost
+        pending_routes, viewed_nodes = self._pass_view(pre_routes)
+
+        moves = 0
+        locked: Set[Route] = set()
+        for local_disc, from_node, to_node in merged_disc:
+            if self._out_of_time():
+                break
+
+            start = len(journal)
+            if self._try_entry(pre_routes, to_node, pending_routes, viewed_nodes, locked, journal, init_cost):
+                moves += 1
+                if not self.multi_move:
+                    break
+
+                locked.update(route for route, _ in journal[start:])
+                init_cost = pre_routes.cost
+
+        self.potentials.update(list(dict.fromkeys(route for route, _ in journal)))
+        return moves
+
+    def _pass_view(self, pre_routes: RouteList) -> Tuple[RouteList, Dict[GeoNode, List[Route]]]:
+        # routes with free space and the ones seen from every consumer by its neighbours
+        pending_routes = pre_routes.blank_routes
 
         viewed_nodes: Dict[GeoNode, List[Route]] = defaultdict(lambda: [])
         for from_node in self.sys.consumers:
@@ -225,50 +366,215 @@ class RouteBuilder(object):
                 if isinstance(to_node, Consumer):
                     viewed_nodes[to_node] += from_routes
 
-        for local_disc, from_node, to_node in merged_disc:
-            to_routes = pending_routes.by_tail(to_node).sort_occupancy
-            alt_routes = sorted(viewed_nodes[to_node], key=lambda r: r.tail.dist(to_node) * r.occupancy)
-
-            for route in to_routes:
-                route_snapshot = pre_routes.snapshot
-                upd_routes = RouteList([route])
-
-                for alt_route in alt_routes:
-                    upd_routes.append(alt_route)
-                    if alt_route.take_over(route):
-                        new_view = [alt_route] + viewed_nodes[route.tail]
-                        alt_routes = sorted(filter(lambda r: r.tail.dist(route.tail), new_view),
-                                            key=lambda r: r.tail.dist(route.tail) * r.occupancy)
-
-                    if route.warehouse is None:
-                        if pre_routes.cost - route.cost * 2 <= init_cost:
-                            pre_routes.remove(route)
-                            return True
-                        else:
-                            break
-
-                    new_cost = pre_routes.cost
-                    if new_cost < init_cost:
-                        return True
-                    elif new_cost - route.cost > init_cost:
-                        break
-
-                self.sys.balance_rollback(balance_snapshot)
-                upd_routes.rollback(route_snapshot)
+        return pending_routes, viewed_nodes
+
+    def _try_entry(self, pre_routes: RouteList, to_node: GeoNode, pending_routes: RouteList,
+                   viewed_nodes: Dict[GeoNode, List[Route]], locked: Set[Route],
+                   journal: RouteJournal, init_cost: float) -> bool:
+        # the first route ending in to_node that can be taken over, the others are rolled back
+        to_routes = pending_routes.by_tail(to_node).sort_occupancy
+        alt_routes = self._alternatives([r for r in viewed_nodes[to_node] if r not in locked], to_node)
+
+        for route in to_routes:
+            if route in locked or self._out_of_time():
+                continue
+
+            savepoint = journal.savepoint()
+            balance_savepoint = self.sys.balance_savepoint()
+            moved, alt_routes = self._move(pre_routes, route, alt_routes, viewed_nodes, locked, journal, init_cost)
+            if moved:
+                return True
+
+            self.sys.balance_rollback(balance_savepoint)
+            journal.rollback(savepoint)
 
         return False
 
+    def _parallel_iteration(self, pre_routes: RouteList) -> int:
+        """
+        Scores the moves of all discrepancy entries in the worker processes,
+        then applies the best ones touching different routes
+
+        Scores are ordered by gain and entry, so the plan does not depend
+        on how the entries were spread over the workers.
+        """
+
+        merged_disc = self.potentials.discrepancy
+        graph = self.sys.graph
+        entries = [(k, graph.index[to_node]) for k, (_, _, to_node) in enumerate(merged_disc)]
+        snapshot = self._snapshot(pre_routes)
+
+        chunks = [entries[i::self.workers] for i in range(self.workers)]
+        futures = [self._pool.submit(_score_moves, snapshot, chunk) for chunk in chunks]
+        timeout = None if self.deadline is None else max(0.0, self.deadline - time.perf_counter())
+        _, not_done = wait(futures, timeout)
+        if not_done:
+            # the budget ran out while scoring, the pass is dropped
+            for future in not_done:
+                future.cancel()
+            return 0
+
+        scores = [score for future in futures for score in future.result()]
+        scores.sort(key=lambda score: (-score[1], score[0]))
+
+        chosen: List[int] = []
+        used: Set[int] = set()
+        for k, gain, touched in scores:
+            if used.isdisjoint(touched):
+                chosen.append(k)
+                used.update(touched)
+
+        self.sys.balance_commit()
+        journal = RouteJournal()
+        init_cost = pre_routes.cost
+        pending_routes, viewed_nodes = self._pass_view(pre_routes)
+
+        moves = 0
+        locked: Set[Route] = set()
+        for k in chosen:
+            if self._out_of_time():
+                break
+
+            start = len(journal)
+            if self._try_entry(pre_routes, merged_disc[k][2], pending_routes, viewed_nodes, locked, journal, init_cost):
+                moves += 1
+                locked.update(route for route, _ in journal[start:])
+                init_cost = pre_routes.cost
+
+        self.potentials.update(list(dict.fromkeys(route for route, _ in journal)))
+        return moves
+
+    def _snapshot(self, routes: RouteList) -> Tuple[List[Tuple[np.ndarray, int, Dict[int, ProductList]]],
+                                                    List[ProductList]]:
+        # plan and balances in a form shipped to the workers
+        graph = self.sys.graph
+        tracks = {track: i for i, track in enumerate(self.sys.transport)}
+        plan = [(route.ids(graph), tracks[route.track], dict(route.deliveries)) for route in routes]
+        balances = [node.balance.to_products() for node in self.sys.nodes]
+        return plan, balances
+
+    def _restore(self, snapshot) -> RouteList:
+        plan, balances = snapshot
+        graph = self.sys.graph
+
+        routes = RouteList()
+        for ids, track, loads in plan:
+            route = Route.from_ids(ids, graph, self.metric, loads)
+            route.set_track(self.sys.transport[track])
+            routes.append(route)
+
+        self.sys.init_balance()
+        for node, products in zip(self.sys.nodes, balances):
+            node.balance.counts.fill(0)
+            node.balance.deposit(products)
+        self.sys.balance_commit()
+        return routes
+
+    def _score(self, snapshot, entries: List[Tuple[int, int]]) -> List[Tuple[int, float, List[int]]]:
+        # gain and touched routes of the move of every entry, each move is rolled back
+        routes = self._restore(snapshot)
+        order = list(routes)
+        positions = {route: i for i, route in enumerate(routes)}
+        pending_routes, viewed_nodes = self._pass_view(routes)
+
+        journal = RouteJournal()
+        init_cost = routes.cost
+        scores = []
+        for k, to_id in entries:
+            if self._try_entry(routes, self.sys.graph.nodes[to_id], pending_routes, viewed_nodes, set(), journal, init_cost):
+                touched = sorted({positions[route] for route, _ in journal})
+                scores.append((k, init_cost - routes.cost, touched))
+
+                self.sys.balance_rollback(0)
+                journal.rollback(0)
+                routes[:] = order
+
+        return scores
+
+    def _move(self, pre_routes: RouteList, route: Route, alt_routes: List[Route],
+              viewed_nodes: Dict[GeoNode, List[Route]], locked: Set[Route],
+              journal: RouteJournal, init_cost: float) -> Tuple[bool, List[Route]]:
+        # hands route over to the alternatives until the plan gets cheaper,
+        # the alternatives seen from the new tail are kept for the next route.
+        # delta is the plan cost change since init_cost, summed over take-overs
+        delta = 0.0
+        view = alt_routes
+        for alt_route in view:
+            if alt_route in locked:
+                continue
+
+            taken, take_delta = alt_route.take_over(route, journal)
+            delta += take_delta
+            if self.debug:
+                self._check_delta(pre_routes, init_cost, delta)
+            if taken:
+                new_view = [alt_route] + [r for r in viewed_nodes[route.tail] if r not in locked]
+                alt_routes = self._alternatives(new_view, route.tail, linked_only=True)
+
+            if route.warehouse is None:
+                if delta - route.cost * 2 <= COST_EPS:
+                    pre_routes.remove(route)
+                    return True, alt_routes
+                else:
+                    return False, alt_routes
+
+            if delta < -COST_EPS:
+                return True, alt_routes
+            elif delta - route.cost > COST_EPS:
+                return False, alt_routes
+
+        return False, alt_routes
+
+    @staticmethod
+    def _check_delta(pre_routes: RouteList, init_cost: float, delta: float):
+        cost = sum(route.cost for route in pre_routes)
+        if abs(init_cost + delta - cost) > 1e-6 * max(1.0, cost):
+            raise Exception(f'Take-over delta {delta} does not match the plan cost change {cost - init_cost}')
+
+    def _alternatives(self, routes: List[Route], node: GeoNode, linked_only=False) -> List[Route]:
+        # routes ordered by road weight from their tail to node times occupancy
+        if not routes:
+            return []
+
+        graph = self.sys.graph
+        tails = graph.encode([route.tail for route in routes])
+        weights = graph.weights_to(tails, graph.index[node], self.metric)
+        if linked_only:
+            kept = np.flatnonzero(np.isfinite(weights) & (weights != 0))
+            routes, weights = [routes[i] for i in kept], weights[kept]
+
+        keys = weights * np.array([route.occupancy for route in routes])
+        return [routes[i] for i in np.argsort(keys, kind='stable')]
+
     def _potential_optimize(self, pre_routes: RouteList, iter_limit: int = MAX_ITER) -> RouteList:
         if not iter_limit:
             return pre_routes
 
         self._product_dict()
-
+        self.pass_moves = []
+
+        if self.workers > 1 and not self._out_of_time():
+            self._pool = ProcessPoolExecutor(self.workers, initializer=_init_worker,
+                                             initargs=(TransportSystem.Loader.dumps(self.sys), self.metric))
+            try:
+                return self._optimize_passes(pre_routes, iter_limit)
+            finally:
+                # workers still scoring a dropped pass are not waited for
+                self._pool.shutdown(wait=not self._out_of_time(), cancel_futures=True)
+                self._pool = None
+        return self._optimize_passes(pre_routes, iter_limit)
+
+    def _optimize_passes(self, pre_routes: RouteList, iter_limit: int) -> RouteList:
         for i in range(iter_limit):
+            if self._out_of_time():
+                print(f'Time budget ran out after {i} optimization stages')
+                break
+
             upd = self._optimization_iteration(pre_routes)
             if not upd:
                 break
-            print(f'{i} optimization stage done')
+            self.pass_moves.append(upd)
+            print(f'{i} optimization stage done, {upd} moves')
         else:
             print(f'Iteration limit {MAX_ITER} reached')
 
@@ -291,38 +597,23 @@ class RouteBuilder(object):
                 else:
                     self.prod_nodes[prod.name] = [cnode]
 
-    def _calculate_potentials(self, routes: List[Route]) -> Dict[str, ProductPot]:
-        pot = {prod: ProductPot() for prod in self.prod_nodes.keys()}
+    def _close_routes(self, routes: RouteList) -> RouteList:
+        self.road_map.find_routes(self.sys.parking)
 
         for route in routes:
-            for prod in route.prod_names:
-                pot[prod].apply_route(route)
-
-        return pot
+            route_back = self.road_map.route(route.tail, self.sys.parking)
+            route.prolong(route_back)
 
-    def _calculate_discrepancy(self, pot: Dict[str, ProductPot], routes: RouteList) -> Dict[str, ProductDisc]:
-        disc: Dict[str, ProductDisc] = {prod: ProductDisc(prod, prod_pot, routes) for prod, prod_pot in pot.items()}
-        return disc
+        return routes
 
-    def _merge_discrepancy(self, disc: Dict[str, ProductDisc]) -> List[Tuple[float, GeoNode, GeoNode]]:
-        prod_min: Dict[GeoNode, Tuple[float, GeoNode, GeoNode]] = defaultdict(lambda: (1e10, None, None))
-        # merged_disc: List[Tuple[float, GeoNode, GeoNode]] = []
-        for prod, prod_disc in disc.items():
-            for val in prod_disc:
-                if val[0] < prod_min[val[2]][0]:
-                    prod_min[val[2]] = val
-            # merged_disc += prod_disc
 
-        merged_disc = [val for val in prod_min.values()]
+_worker: RouteBuilder | None = None
 
-        merged_disc.sort(key=lambda x: x[0])
-        return merged_disc
 
-    def _close_routes(self, routes: RouteList) -> RouteList:
-        self.road_map.find_routes(self.sys.parking)
+def _init_worker(data: str, metric: str):
+    global _worker
+    _worker = RouteBuilder(TransportSystem.Loader.loads(data), metric=metric)
 
-        for route in routes:
-            route_back = self.road_map.route(route.tail, self.sys.parking)
-            route.prolong(route_back)
 
-        return routes
+def _score_moves(snapshot, entries: List[Tuple[int, int]]) -> List[Tuple[int, float, List[int]]]:
+    return _worker._score(snapshot, entries)
@@ -20,9 +20,11 @@ def required_offset(from1: dt.timedelta, to1: dt.timedelta, from2: dt.timedelta,
 
 
 class RouteSchedule(Route):
+    __slots__ = ('_begin', '_arrival', '_departure', '_timeline')
     _begin: dt.timedelta
     _arrival: List[dt.timedelta]
     _departure: List[dt.timedelta]
+    _timeline: List[Tuple[dt.timedelta, dt.timedelta]]
     intervals = {
         Parking: dt.timedelta(minutes=2),
         Warehouse: dt.timedelta(minutes=10),
@@ -31,17 +33,18 @@ class RouteSchedule(Route):
     }
 
     def __init__(self, route: Route, begin: dt.timedelta):
-        super(RouteSchedule, self).__init__(*route.nodes)
+        super(RouteSchedule, self).__init__(*route.nodes, metric=route.metric)
         self.track = None
         self.loads = route.loads
 
         self._begin = begin
+        self._timeline = self._build_timeline()
         self.schedule()
 
-    def schedule(self):
-        self._arrival = []
-        self._departure = []
-        current_time = self._begin
+    def _build_timeline(self) -> List[Tuple[dt.timedelta, dt.timedelta]]:
+        # arrival and departure offsets from the route begin, they don't depend on it
+        timeline = []
+        current_time = dt.timedelta(0)
 
         last_node: Optional[GeoNode] = None
         for node, load, i in zip(self.nodes, self.loads, range(len(self.nodes))):
@@ -52,11 +55,15 @@ class RouteSchedule(Route):
                 interval = self.intervals[type(node)]
             else:
                 interval = dt.timedelta(0)
-            self._arrival.append(current_time)
+            timeline.append((current_time, current_time + interval))
             current_time += interval
-            self._departure.append(current_time)
 
             last_node = node
+        return timeline
+
+    def schedule(self):
+        self._arrival = [self._begin + arrival for arrival, _ in self._timeline]
+        self._departure = [self._begin + departure for _, departure in self._timeline]
 
     def shove(self, other: 'RouteSchedule') -> bool:
         """
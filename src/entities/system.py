@@ -1,16 +1,25 @@
-from copy import copy
-from typing import List, Optional, Union, TextIO, Dict
+import io
+from typing import List, Optional, Union, TextIO
 
 import jsonpickle
 
 from entities.nodes import Warehouse, Parking, Consumer
 from entities.nodes.geonode import GeoNode
+from entities.product import ProductLedger, LedgerJournal, ProductCatalog
+from entities.node_registry import NodeRegistry
 from entities.road import Road
+from entities.road_graph import RoadGraph
 from entities.route import Route, RouteList
 from entities.transport import Transport
 
 
 class TransportSystem(object):
+    _graph: Optional[RoadGraph] = None
+    _registry: Optional[NodeRegistry] = None
+    _journal: Optional[LedgerJournal] = None
+    _catalog: Optional[ProductCatalog] = None
+    _revision: int = 0  # bumped by the changes of nodes and links made through the system
+
     def __init__(self):
         self.routes: List[Route] = []
 
@@ -36,22 +45,24 @@ class TransportSystem(object):
         return data
 
     def init_balance(self, routes: RouteList = None):
+        self._journal = LedgerJournal()
+        for node in self.nodes:
+            node.balance = ProductLedger(journal=self._journal, catalog=self.catalog)
+
         for wnode in self.warehouses:
-            for prod in wnode.stock:
-                wnode.balance[prod.name] = prod.amount
+            wnode.balance.deposit(wnode.stock)
 
         for cnode in self.consumers:
-            for prod in cnode.order:
-                cnode.balance[prod.name] = -prod.amount
-
-        if not routes:
-            return
+            cnode.balance.minus(cnode.order)
 
-        for route in routes:
-            for node, load in zip(route.nodes, route.loads):
-                mult = -1 if isinstance(node, Warehouse) else 1
-                for prod in load:
-                    node.balance[prod.name] += mult * prod.amount
+        for route in routes or []:
+            for i, load in route.deliveries:
+                node = route.nodes[i]
+                if isinstance(node, Warehouse):
+                    node.balance.minus(load)
+                else:
+                    node.balance.deposit(load)
+        self._journal.clear()
 
     def check_valid(self) -> None:
         if self.parking is None:
@@ -68,25 +79,33 @@ class TransportSystem(object):
             if parking_road is not None:
                 node.add_node(self.parking, parking_road)
 
+        self.registry.add(node, int(self.parking is not None) + len(self.warehouses))
         self.warehouses.append(node)
+        self._revision += 1
 
     def add_consumer(self, node: Consumer):
+        self.registry.add(node)
         self.consumers.append(node)
+        self._revision += 1
 
     def add_parking(self, node: Parking):
+        if self.parking is not None:
+            self.registry.remove(self.parking)
+        self.registry.add(node, 0)
         self.parking = node
+        self._revision += 1
 
     def add_transport(self, truck: Transport):
         truck.volume = self.con
         self.parking.add_transport(truck)
 
     def add_link(self, ind1: int, ind2: int, dist=1.0, time=1.0):
-        if max(ind1, ind2) >= len(self.nodes) or min(ind1, ind2) < 0 or ind1 == ind2:
+        nodes = self.nodes
+        if max(ind1, ind2) >= len(nodes) or min(ind1, ind2) < 0 or ind1 == ind2:
             raise Exception('Wrong index')
 
-        obj1 = self.nodes[ind1]
-        obj2 = self.nodes[ind2]
-        obj1.add_node(obj2, Road(dist, time))
+        nodes[ind1].add_node(nodes[ind2], Road(dist, time))
+        self._revision += 1
 
     def unlinked(self, node: GeoNode):
         return list(filter(
@@ -95,18 +114,19 @@ class TransportSystem(object):
         ))
 
     def del_node(self, key: GeoNode):
-        if key == self.parking:
+        if key not in self.registry:
+            raise Exception('No such node')
+
+        if key is self.parking:
             self.parking = None
-        elif key in self.consumers:
-            key: Consumer
-            self.consumers.remove(key)
-        elif key in self.warehouses:
-            key: Warehouse
-            self.warehouses.remove(key)
+        elif isinstance(key, Consumer):
+            del self.consumers[self._position(self.consumers, key)]
         else:
-            raise Exception('No such node')
+            del self.warehouses[self._position(self.warehouses, key)]
 
+        self.registry.remove(key)
         key.unlink()
+        self._revision += 1
 
     def __delitem__(self, key: Union[GeoNode, int]):
         if isinstance(key, GeoNode):
@@ -132,52 +152,157 @@ class TransportSystem(object):
     def transport(self) -> List[Transport]:
         return self.parking.transport
 
-    @property
-    def nodes(self) -> List[GeoNode]:
+    @staticmethod
+    def _position(nodes: List[GeoNode], node: GeoNode) -> int:
+        last = len(nodes) - 1
+        if nodes[last] is node:
+            return last
+        return next(i for i, other in enumerate(nodes) if other is node)
+
+    def _ordered_nodes(self) -> List[GeoNode]:
         res = [self.parking] if self.parking is not None else []
         res += self.warehouses
         res += self.consumers
         return res
 
     @property
-    def balance_snapshot(self) -> Dict[GeoNode, Dict[str, int]]:
-        snapshot: Dict[GeoNode, Dict[str, int]] = {}
-        for node in self.nodes:
-            snapshot[node] = copy(node.balance)
-        return snapshot
+    def registry(self) -> NodeRegistry:
+        if self._registry is None:
+            self._registry = NodeRegistry(self._ordered_nodes())
+        return self._registry
 
-    def balance_rollback(self, snapshot: Dict[GeoNode, Dict[str, int]]):
-        for node in self.nodes:
-            node.balance = snapshot[node]
+    def _ordered_registry(self) -> NodeRegistry:
+        registry = self.registry
+        if registry.order is None:
+            registry.set_order(self._ordered_nodes())
+        return registry
+
+    @property
+    def nodes(self) -> List[GeoNode]:
+        """
+        Parking, warehouses and consumers in this order
+
+        The list is cached between changes of the system, don't modify it.
+        """
+
+        return self._ordered_registry().order
+
+    def __contains__(self, node: GeoNode) -> bool:
+        return node in self.registry
+
+    def index(self, node: GeoNode) -> int:
+        return self._ordered_registry().position(node)
+
+    def node_id(self, node: GeoNode) -> int:
+        return self.registry.ids[node]
+
+    def node_by_id(self, node_id: int) -> GeoNode:
+        return self.registry.by_id[node_id]
+
+    @property
+    def graph(self) -> RoadGraph:
+        """
+        CSR snapshot of the roads, rebuilt when they change
+
+        Links and roads changed on the nodes directly are only seen through
+        the process wide revisions of GeoNode and Road, when those move the
+        roads are compared and the snapshot is kept if they are the same.
+        """
+
+        revision = (self._revision, GeoNode.revision, Road.revision)
+        graph = self._graph
+        if graph is None or graph.revision != revision:
+            new = RoadGraph(self.nodes, revision)
+            if graph is None or graph.revision[0] != self._revision or not graph.same_roads(new):
+                self._graph = new
+            else:
+                graph.revision = revision
+        return self._graph
+
+    @property
+    def catalog(self) -> ProductCatalog:
+        """
+        Products of this system, balances and ledgers of its builders use it
+        """
+
+        if self._catalog is None:
+            self._catalog = ProductCatalog(shared=True)
+        return self._catalog
+
+    def balance_savepoint(self) -> int:
+        """
+        Balance changes made after init_balance() are journaled, rolling
+        back to a savepoint undoes only the changes made since then
+        """
+
+        return self._journal.savepoint()
+
+    def balance_rollback(self, savepoint: int):
+        self._journal.rollback(savepoint)
+
+    def balance_commit(self):
+        self._journal.clear()
 
     class Loader:
         @staticmethod
         def pack(sys: 'TransportSystem'):
-            node_id = {node: id for id, node in enumerate(sys.nodes)}
+            vars(sys).pop('_graph', None)
+            vars(sys).pop('_journal', None)
+            vars(sys).pop('_catalog', None)
+            vars(sys).pop('_revision', None)
 
             for node in sys.nodes:
-                node.linked_id = {node_id[other]: road for other, road in node.linked.items()}
+                node.linked_id = {sys.index(other): road for other, road in node.linked.items()}
                 node.balance = {}
                 del node.linked
+            vars(sys).pop('_registry', None)
 
         @staticmethod
         def unpack(sys: 'TransportSystem'):
             for node in sys.nodes:
+                if not hasattr(node, 'pos'):
+                    node.pos = None
                 if not hasattr(node, 'linked_id'):
                     continue
                 node.linked = {sys.nodes[node_id]: road for node_id, road in node.linked_id.items()}
                 del node.linked_id
+                node.balance = None
+            sys._revision += 1
 
         @classmethod
-        def save(cls, sys: 'TransportSystem', f_name: str):
+        def dumps(cls, sys: 'TransportSystem') -> str:
+            """
+            JSON of the system, its balances are left as they were
+            """
+
+            registry, journal, catalog = sys.registry, sys._journal, sys._catalog
+            revision, graph = sys._revision, sys._graph
+            balances = {node: node.balance for node in sys.nodes}
             cls.pack(sys)
-            with open(f_name, 'w', encoding='utf-8') as f:
-                sys.save_json(f)
+            f = io.StringIO()
+            sys.save_json(f)
             cls.unpack(sys)
+            sys._registry = registry
+            sys._journal = journal
+            sys._catalog = catalog
+            sys._revision, sys._graph = revision, graph
+            for node, balance in balances.items():
+                node.balance = balance
+            return f.getvalue()
 
         @classmethod
-        def load(cls, f_name: str) -> 'TransportSystem':
-            with open(f_name, 'r', encoding='utf-8') as f:
-                sys = TransportSystem.load_json(f)
+        def loads(cls, data: str) -> 'TransportSystem':
+            sys = TransportSystem.load_json(io.StringIO(data))
             cls.unpack(sys)
             return sys
+
+        @classmethod
+        def save(cls, sys: 'TransportSystem', f_name: str):
+            data = cls.dumps(sys)
+            with open(f_name, 'w', encoding='utf-8') as f:
+                f.write(data)
+
+        @classmethod
+        def load(cls, f_name: str) -> 'TransportSystem':
+            with open(f_name, 'r', encoding='utf-8') as f:
+                return cls.loads(f.read())
@@ -1,4 +1,6 @@
 class Transport:
+    __slots__ = ('name', 'volume')
+
     def __init__(self, name="", volume=10.0, cons=1.0):
         self.name: str = name
         self.volume: float = volume
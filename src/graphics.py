@@ -21,7 +21,7 @@ class GraphBuilder:
         for node in self.sys.nodes:
             g.add_node(node.name)
             for other, road in node.linked.items():
-                g.add_edge(node.name, other.name, weight=1 / road.dist, **road.__dict__)
+                g.add_edge(node.name, other.name, weight=1 / road.dist, dist=road.dist, time=road.time)
         return g
 
     def _build_nodes(self, subp):
@@ -83,7 +83,10 @@ class GraphBuilder:
     def figure(self) -> plt.Figure:
         plt.close('all')
         self.g = self.graph()
-        self.pos = nx.spring_layout(self.g, seed=10)
+        if all(node.pos is not None for node in self.sys.nodes):
+            self.pos = {node.name: node.pos for node in self.sys.nodes}
+        else:
+            self.pos = nx.spring_layout(self.g, seed=10)
 
         fig: plt.Figure = plt.figure()
         subp = fig.add_subplot(111)
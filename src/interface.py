@@ -216,8 +216,9 @@ class MainWin(QtWidgets.QMainWindow):
     def build_routes(self):
         self.clean_routes()
         try:
-            route_builder = RouteBuilder(self.sys)
-            self.routes = route_builder.calc_routes(self.config.iters, self.config.begin_t, self.config.end_t)
+            route_builder = RouteBuilder(self.sys, metric=self.config.metric)
+            self.routes = route_builder.calc_routes(self.config.iters, self.config.begin_t, self.config.end_t,
+                                                    self.config.time_budget or None)
             self.routes.sort(key=lambda r: r.begin)
         except Exception as e:
             self.ui.err_msg(str(e))
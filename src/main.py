@@ -2,6 +2,7 @@ import sys
 
 import ui.styles as st
 from interface import *
+from entities.road_map import shared_maps
 from interface import MainWin
 from system_generator import random_system
 
@@ -18,6 +19,7 @@ def main(tsys: TransportSystem):
 
 
 if __name__ == '__main__':
+    shared_maps.cache_dir = './cache/'
     tsys = None # random_system(100, 10, radius=0.2)
     # TransportSystem.Loader.save(tsys, './configs/rnd100.json')
     # route_builder = RouteBuilder(init_system())
@@ -1,10 +1,14 @@
 import random
 import time
+import tracemalloc
 from typing import List
 
 import matplotlib.pyplot as plt
 
 from entities import TransportSystem, RouteBuilder
+from entities.route import RouteList
+from entities.road_hierarchy import HierarchyRoadMap
+from entities.road_map import RoadMap, shared_maps
 from system_generator import random_system
 
 
@@ -138,6 +142,72 @@ def time_research(sizes):
     plt.show()
 
 
+def road_map_research(sizes, query_n=1000):
+    for size in sizes:
+        tsys = random_system(size, size // 10, seed=size, radius=2 / size ** 0.5)
+        pairs = [(random.choice(tsys.nodes), random.choice(tsys.nodes)) for _ in range(query_n)]
+
+        hierarchy_map = HierarchyRoadMap(tsys)
+        hierarchy_map.build()
+        t_begin = time.process_time()
+        for from_node, to_node in pairs:
+            hierarchy_map.dist(from_node, to_node)
+        hierarchy_time = (time.process_time() - t_begin) / query_n
+
+        road_map = RoadMap(tsys)
+        t_begin = time.process_time()
+        for from_node, to_node in pairs[:query_n // 10]:
+            road_map.find_routes(from_node)
+        dijkstra_time = (time.process_time() - t_begin) / (query_n // 10)
+
+        print(f'{size}: build {hierarchy_map.build_time:.3f} s, '
+              f'query {hierarchy_time * 1e6:.1f} us, dijkstra {dijkstra_time * 1e6:.1f} us')
+
+
+def memory_research(sizes, repeat_n=100):
+    for size in sizes:
+        tracemalloc.start()
+        tsys = random_system(size, size // 10, seed=size)
+        sys_memory = tracemalloc.get_traced_memory()[0]
+        routes = RouteList(RouteBuilder(tsys).calc_routes(0))
+        plan_memory = tracemalloc.get_traced_memory()[0] - sys_memory
+
+        tracemalloc.reset_peak()
+        base_memory = tracemalloc.get_traced_memory()[0]
+        snapshot = routes.snapshot
+        snapshot_memory = tracemalloc.get_traced_memory()[0] - base_memory
+        del snapshot
+        tracemalloc.stop()
+
+        t_begin = time.process_time()
+        for i in range(repeat_n):
+            routes.snapshot
+        snapshot_time = (time.process_time() - t_begin) / repeat_n
+
+        print(f'{size}: system {sys_memory / 2 ** 10:.0f} KiB, plan {plan_memory / 2 ** 10:.0f} KiB, '
+              f'snapshot {snapshot_memory / 2 ** 10:.0f} KiB in {snapshot_time * 1e3:.2f} ms')
+
+
+def route_cost_research(sizes, repeat_n=100):
+    for size in sizes:
+        tsys = random_system(size, size // 10, seed=size)
+        routes = RouteList(RouteBuilder(tsys).calc_routes(0))
+        graph = tsys.graph
+        encoded = [route.ids(graph) for route in routes]
+
+        t_begin = time.process_time()
+        for i in range(repeat_n):
+            [sum(a.linked[b].dist for a, b in zip(route.nodes[:-1], route.nodes[1:])) for route in routes]
+        loop_time = (time.process_time() - t_begin) / repeat_n
+
+        t_begin = time.process_time()
+        for i in range(repeat_n):
+            graph.costs(encoded)
+        batch_time = (time.process_time() - t_begin) / repeat_n
+
+        print(f'{size}: {len(routes)} routes, loop {loop_time * 1e3:.3f} ms, batch {batch_time * 1e3:.3f} ms')
+
+
 def cmp_truck():
     repeat_n = 2
     end_cost = []
@@ -202,6 +272,7 @@ def main(case):
             print(f'no {case} research')
 
 if __name__ == '__main__':
+    shared_maps.cache_dir = './cache/'
     # main('cmp_optimize_low')
 
     cmp_parking_dist()
@@ -43,6 +43,9 @@ def random_system(node_n: int, warehouse_n: int, seed=1, con=5.0, vol=0.1, profi
     for i in range(TRUCK_N):
         sys.add_transport(Transport('Нива'))
 
+    for i, node in enumerate(sys.nodes):
+        node.pos = tuple(G.nodes[i]['pos'])
+
     for edge in G.edges:
         ind0, ind1 = trans[edge[0]], trans[edge[1]]
         node0, node1 = G.nodes[ind0], G.nodes[ind1]
@@ -1,6 +1,15 @@
+import datetime as dt
+import tempfile
 import unittest
+from copy import copy
 
-from entities import TransportSystem, RouteBuilder, Parking, Warehouse, Product, Consumer, Road, Transport
+from entities import TransportSystem, RouteBuilder, Parking, Warehouse, Product, Consumer, Road, Transport, Route
+from entities.product import ProductLedger, ProductList, ProductCatalog
+from entities.route import RouteJournal, RouteList
+from entities.route_shedule import RouteSchedule
+from entities.road_hierarchy import HierarchyRoadMap
+from entities.road_map import RoadMap, MatrixRoadMap, RoadMapCache
+from system_generator import random_system
 
 
 def small_sys() -> TransportSystem:
@@ -17,6 +26,53 @@ def small_sys() -> TransportSystem:
     return tsys
 
 
+def planned_sys(node_n: int, warehouse_n: int, seed: int, **options) -> tuple:
+    """
+    Random system, its route builder and the initial plan the balances are set from
+    """
+
+    tsys = random_system(node_n, warehouse_n, seed=seed)
+    builder = RouteBuilder(tsys, **options)
+    routes = builder._min_elem_routes()
+    tsys.init_balance(routes)
+    return tsys, builder, routes
+
+
+def check_pairs(test: unittest.TestCase, tsys: TransportSystem, check, targets=None):
+    # check(node, other) from the first ten nodes to targets or all nodes, a subtest per pair
+    for node in tsys.nodes[:10]:
+        for other in tsys.nodes if targets is None else targets:
+            with test.subTest(node=node, other=other):
+                check(node, other)
+
+
+def full_discrepancy(builder: RouteBuilder, routes: RouteList) -> list:
+    """
+    Merged discrepancy of the plan computed from scratch, which
+    PotentialState keeps up to date between iterations
+    """
+
+    graph = builder.sys.graph
+    adjacency = graph.adjacency(builder.metric)
+    merged = {}
+    for prod in builder.prod_nodes:
+        pot = {}
+        for route in routes:
+            if prod in route.prod_names:
+                for node, cost in route.node_cost.items():
+                    pot[node] = min(pot.get(node, cost), cost)
+
+        for node, node_pot in pot.items():
+            i = graph.index[node]
+            if not graph.consumers[i]:
+                continue
+            for other, dist in adjacency[i]:
+                delta = -node_pot + dist
+                if graph.consumers[other] and delta < 0 and delta < merged.get(node, (1e10,))[0]:
+                    merged[node] = (delta, graph.nodes[other], node)
+    return sorted(merged.values(), key=lambda d: d[0])
+
+
 class MyTestCase(unittest.TestCase):
     def case(self, filename: str, want_route_n: int):
         tsys = TransportSystem.Loader.load(f'./configs/{filename}.json')
@@ -46,6 +102,448 @@ class MyTestCase(unittest.TestCase):
             with self.subTest(filename=filename, want=want):
                 self.case(filename, want)
 
+    def test_node_registry(self):
+        tsys = small_sys()
+        warehouse, consumer = tsys.warehouses[0], tsys.consumers[1]
+        ids = {node: tsys.node_id(node) for node in tsys.nodes}
+        self.assertIs(tsys.nodes, tsys.nodes)
+
+        tsys.add_warehouse(Warehouse('Склад №2'), Road())
+        del tsys[tsys.consumers[0]]
+        self.assertNotIn(Consumer('Магазин №1'), tsys)
+        self.assertEqual([node.name for node in tsys.nodes], ['Стоянка', 'Склад №1', 'Склад №2', 'Магазин №2'])
+        self.assertEqual([tsys.index(node) for node in tsys.nodes], list(range(4)))
+        for node in (tsys.parking, warehouse, consumer):
+            self.assertIs(tsys.node_by_id(ids[node]), node)
+
+        nodes = tsys.nodes
+        tsys.add_warehouse(Warehouse('Склад №3'), Road())
+        self.assertIs(tsys.nodes, nodes)
+        self.assertEqual([node.name for node in nodes], ['Стоянка', 'Склад №1', 'Склад №2', 'Склад №3', 'Магазин №2'])
+        self.assertEqual([tsys.index(node) for node in nodes], list(range(5)))
+
+    def test_slots_save_load(self):
+        tsys = random_system(20, 2, seed=4)
+        routes = RouteBuilder(tsys).calc_routes(0)
+        road = list(tsys.parking.linked.values())[0]
+        for entity in (tsys.parking, tsys.consumers[0], road, routes[0], routes[0].loads[1][0]):
+            self.assertFalse(hasattr(entity, '__dict__'))
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            TransportSystem.Loader.save(tsys, f'{cache_dir}/sys.json')
+            loaded = TransportSystem.Loader.load(f'{cache_dir}/sys.json')
+
+        for node, other in zip(tsys.nodes, loaded.nodes):
+            self.assertEqual((node.name, node.pos), (other.name, other.pos))
+            self.assertEqual([(n.name, r.dist) for n, r in node.linked.items()],
+                             [(n.name, r.dist) for n, r in other.linked.items()])
+
+    def test_route_metrics(self):
+        tsys = random_system(40, 4, seed=3)
+        for route in RouteBuilder(tsys).calc_routes():
+            fresh = Route(*route.nodes, metric=route.metric)
+            self.assertEqual((route.dist, route.time), (fresh.dist, fresh.time))
+            self.assertEqual(route.node_dist, fresh.node_dist)
+
+        route = Route(tsys.parking, *list(tsys.parking.linked)[:1])
+        self.assertEqual(route.cost, tsys.parking.dist(route.tail))
+        back = route.extend(tsys.parking)
+        self.assertEqual(back.cost, 2 * route.cost)
+        route.rollback(back)
+        self.assertEqual(route.cost, back.cost)
+
+    def test_route_journal(self):
+        tsys = small_sys()
+        route = Route(tsys.parking, tsys.warehouses[0])
+        other = Route(tsys.parking)
+        journal = RouteJournal()
+
+        savepoint = journal.savepoint()
+        journal.touch(route)
+        route.add_node(tsys.consumers[0])
+        inner = journal.savepoint()
+        journal.touch(route)
+        journal.touch(route)
+        route.add_node(tsys.consumers[1])
+        self.assertEqual(len(journal), 2)
+
+        journal.rollback(inner)
+        self.assertEqual(route.nodes, [tsys.parking, tsys.warehouses[0], tsys.consumers[0]])
+        journal.rollback(savepoint)
+        self.assertEqual((route.nodes, route.cost), ([tsys.parking, tsys.warehouses[0]], 1.0))
+        self.assertEqual(other.nodes, [tsys.parking])
+
+    def test_sparse_loads(self):
+        tsys = random_system(40, 4, seed=3)
+        for route in RouteBuilder(tsys).calc_routes():
+            self.assertTrue(all(load for _, load in route.deliveries))
+            self.assertEqual(len(route.loads), len(route.nodes))
+
+            amounts = [[(p.name, p.amount) for p in load] for load in route.loads]
+            self.assertEqual([[(p.name, p.amount) for p in load] for load in route.inverse().loads], amounts[::-1])
+
+            schedule = RouteSchedule(route, dt.timedelta(hours=8))
+            self.assertEqual(len(schedule.loads), len(schedule.nodes))
+            for i, load in route.deliveries:
+                self.assertIs(schedule.loads[i], load)
+
+    def test_route_list_columns(self):
+        tsys, builder, routes = planned_sys(40, 4, seed=3)
+
+        self.assertAlmostEqual(routes.cost, sum(route.cost for route in routes))
+        self.assertEqual(routes.blank_routes, [route for route in routes if not route.is_full])
+        self.assertEqual(routes.sort_occupancy, sorted(routes, key=lambda r: r.occupancy))
+        for node in tsys.nodes:
+            self.assertEqual(routes.by_tail(node), [route for route in routes if route.tail == node])
+
+        blank = routes.blank_routes
+        self.assertAlmostEqual(blank.cost, sum(route.cost for route in blank))
+
+        route = blank[0]
+        old_tail = route.tail
+        route.add_node(next(iter(old_tail.linked)))
+        self.assertNotIn(route, routes.by_tail(old_tail))
+        self.assertIn(route, routes.by_tail(route.tail))
+        self.assertAlmostEqual(routes.cost, sum(route.cost for route in routes))
+        self.assertAlmostEqual(blank.cost, sum(route.cost for route in blank))
+
+        route.set_load(route.warehouse, ProductList([Product('пряники', 10 ** 6)]))
+        self.assertNotIn(route, routes.blank_routes)
+        self.assertEqual(routes.sort_occupancy[-1], route)
+
+        route.set_track(Transport('Газель', 10 ** 9))
+        self.assertIn(route, routes.blank_routes)
+        self.assertEqual(routes.sort_occupancy[0], route)
+
+        routes.remove(route)
+        self.assertNotIn(route, routes.by_tail(route.tail))
+
+    def test_incremental_potentials(self):
+        tsys, builder, routes = planned_sys(60, 6, seed=5)
+        builder._product_dict()
+
+        for i in range(10):
+            upd = builder._optimization_iteration(routes)
+            full = full_discrepancy(builder, routes)
+            self.assertEqual(sorted(builder.potentials.discrepancy, key=lambda d: (d[0], tsys.index(d[2]))),
+                             sorted(full, key=lambda d: (d[0], tsys.index(d[2]))))
+            if not upd:
+                break
+
+    def test_multi_move(self):
+        tsys, builder, routes = planned_sys(80, 8, seed=80, multi_move=True)
+        init_cost = routes.cost
+
+        routes = builder._potential_optimize(routes)
+        self.assertLess(routes.cost, init_cost)
+        self.assertGreater(max(builder.pass_moves), 1)
+
+        tsys.init_balance(routes)
+        for consumer in tsys.consumers:
+            self.assertFalse((consumer.balance.counts < 0).any())
+
+    def test_parallel_moves(self):
+        plans = []
+        for i in range(2):
+            tsys, builder, routes = planned_sys(40, 4, seed=40, workers=2)
+            init_cost = routes.cost
+
+            routes = builder._potential_optimize(routes)
+            self.assertLess(routes.cost, init_cost)
+            plans.append([(tsys.index(route.head), tsys.index(route.tail), route.cost) for route in routes])
+
+            tsys.init_balance(routes)
+            for consumer in tsys.consumers:
+                self.assertFalse((consumer.balance.counts < 0).any())
+
+        self.assertEqual(plans[0], plans[1])
+
+    def test_time_budget(self):
+        for workers in (1, 2):
+            tsys = random_system(80, 8, seed=80)
+            builder = RouteBuilder(tsys, workers=workers)
+            schedule = builder.calc_routes(time_budget=0.0)
+
+            self.assertEqual(list(builder.phase_times), ['init', 'optimize', 'close', 'schedule'])
+            self.assertEqual(builder.pass_moves, [])
+            self.assertLess(builder.phase_times['optimize'], 0.05)
+            for route in schedule:
+                self.assertEqual((route.head, route.tail), (tsys.parking, tsys.parking))
+
+    def test_take_over_delta(self):
+        for multi_move in (False, True):
+            tsys, builder, routes = planned_sys(60, 6, seed=5, multi_move=multi_move)
+            builder.debug = True
+            init_cost = routes.cost
+
+            routes = builder._potential_optimize(routes)
+            self.assertLess(routes.cost, init_cost)
+
+        far = next(node for node in tsys.consumers if not routes[0].tail.is_linked(node))
+        self.assertEqual(routes[0].take_over(Route(far)), (False, 0.0))
+
+    def test_time_metric(self):
+        tsys = random_system(40, 4, seed=10)
+        routes = RouteBuilder(tsys, metric='time').calc_routes()
+
+        self.assertTrue(routes)
+        for route in routes:
+            self.assertEqual(route.metric, 'time')
+            self.assertEqual(route.cost, route.time)
+
+
+class ProductLedgerTestCase(unittest.TestCase):
+    def test_ledger(self):
+        catalog = ProductCatalog()
+        stock = ProductLedger.from_products(ProductList([Product('чай', 5, 0.2), Product('кофе', 3, 0.5)]),
+                                            catalog=catalog)
+        order = ProductLedger.from_products(ProductList([Product('кофе', 4, 0.5)]), ProductList([Product('сок', 2)]),
+                                            catalog=catalog)
+
+        cross = order.cross(stock)
+        self.assertEqual([(p.name, p.amount) for p in cross.to_products()], [('кофе', 3)])
+        self.assertAlmostEqual(stock.volume, 2.5)
+        self.assertFalse(stock.covers(order))
+
+        order.minus(cross)
+        self.assertEqual((order['кофе'], order['сок'], order['чай']), (1, 2, 0))
+
+        node = Warehouse('Склад')
+        node.balance = copy(stock)
+        taken = ProductList([Product('кофе', 5, 0.5), Product('сок', 1)]).from_balance(node)
+        self.assertEqual([(p.name, p.amount) for p in taken], [('кофе', 3)])
+        self.assertEqual((node.balance['кофе'], stock['кофе']), (0, 3))
+        self.assertRaises(Exception, stock.covers, ProductLedger.from_products(ProductList([Product('чай', 1)])))
+
+    def test_system_catalogs(self):
+        alone = RouteBuilder(random_system(40, 4, seed=3, con=1.0))._min_elem_routes()
+
+        tsys = random_system(40, 4, seed=3, con=1.0)
+        builder = RouteBuilder(tsys)
+        other = random_system(40, 4, seed=3, con=1.0)
+        for warehouse in other.warehouses:
+            for product in warehouse.stock:
+                product.volume = 0.5
+        for consumer in other.consumers:
+            for product in consumer.order:
+                product.volume = 0.5
+        RouteBuilder(other)
+        routes = builder._min_elem_routes()
+
+        self.assertEqual((len(routes), routes.cost), (len(alone), alone.cost))
+        self.assertIs(builder.all_orders.catalog, tsys.catalog)
+        self.assertIsNot(tsys.catalog, other.catalog)
+
+        self.assertIsNone(Consumer('П').balance)
+        tsys.init_balance()
+        self.assertIs(tsys.consumers[0].balance.catalog, tsys.catalog)
+
+    def test_balance_rollback(self):
+        tsys = small_sys()
+        tsys.init_balance()
+        warehouse, consumer = tsys.warehouses[0], tsys.consumers[0]
+        load = ProductList([Product('шоколад', 3, tsys.vol)])
+
+        savepoint = tsys.balance_savepoint()
+        load.from_balance(warehouse).to_balance(consumer)
+        inner = tsys.balance_savepoint()
+        load.from_balance(warehouse).to_balance(consumer)
+        self.assertEqual((warehouse.balance['шоколад'], consumer.balance['шоколад']), (4, 2))
+
+        tsys.balance_rollback(inner)
+        self.assertEqual((warehouse.balance['шоколад'], consumer.balance['шоколад']), (7, -1))
+        tsys.balance_rollback(savepoint)
+        self.assertEqual((warehouse.balance['шоколад'], consumer.balance['шоколад']), (10, -4))
+
+
+class RoadMapTestCase(unittest.TestCase):
+    def test_matrix_dists(self):
+        tsys = random_system(60, 6, seed=3)
+        road_map = RoadMap(tsys)
+        matrix_map = MatrixRoadMap(tsys)
+
+        def check(node, other):
+            self.assertAlmostEqual(road_map.dist(node, other), matrix_map.dist(node, other))
+            self.assertAlmostEqual(matrix_map.route(node, other).dist, matrix_map.dist(node, other))
+
+        check_pairs(self, tsys, check)
+
+    def test_hierarchy_dists(self):
+        tsys = random_system(60, 6, seed=4)
+        road_map = RoadMap(tsys)
+        hierarchy_map = HierarchyRoadMap(tsys)
+
+        def check(node, other):
+            self.assertAlmostEqual(road_map.dist(node, other), hierarchy_map.dist(node, other))
+            self.assertAlmostEqual(hierarchy_map.route(node, other).dist, road_map.dist(node, other))
+
+        check_pairs(self, tsys, check)
+
+    def test_time_paths(self):
+        tsys = random_system(60, 6, seed=11)
+        dist_map = RoadMap(tsys)
+        time_map = RoadMap(tsys, metric='time')
+
+        def check(node, other):
+            route = time_map.route(node, other)
+            self.assertAlmostEqual(route.time, time_map.dist(node, other))
+            self.assertLessEqual(route.time, dist_map.route(node, other).time + 1e-9)
+
+        check_pairs(self, tsys, check)
+
+    def test_a_star_routes(self):
+        tsys = random_system(60, 6, seed=6)
+        road_map = RoadMap(tsys)
+        want = RoadMap(tsys)
+        self.assertIsNotNone(road_map.scale)
+
+        def check(node, other):
+            self.assertAlmostEqual(road_map.route(node, other).dist, want.dist(node, other))
+
+        check_pairs(self, tsys, check, tsys.nodes[-10:])
+        self.assertFalse(road_map.dists)
+
+    def test_sync_roads(self):
+        tsys = random_system(60, 6, seed=5)
+        road_map = RoadMap(tsys)
+        for node in tsys.nodes[:10]:
+            road_map.find_routes(node)
+
+        node = tsys.consumers[0]
+        other = list(node.linked)[0]
+        node.add_node(other, Road(node.dist(other) * 3))
+        tsys.consumers[1].unlink()
+        tsys.consumers[1].add_node(tsys.consumers[2], Road(0.1))
+        road_map.sync()
+
+        want = RoadMap(tsys)
+
+        def check(node, other):
+            self.assertAlmostEqual(road_map.dist(node, other), want.dist(node, other))
+
+        check_pairs(self, tsys, check)
+
+    def test_road_graph(self):
+        tsys = random_system(30, 4, seed=2)
+        graph = tsys.graph
+        self.assertIs(tsys.graph, graph)
+
+        for i, node in enumerate(graph.nodes):
+            begin, end = graph.offsets[i], graph.offsets[i + 1]
+            linked = {graph.nodes[j]: (dist, time) for j, dist, time in
+                      zip(graph.neighbors[begin:end], graph.dist[begin:end], graph.time[begin:end])}
+            self.assertEqual(linked, {other: (road.dist, road.time) for other, road in node.linked.items()})
+            self.assertEqual(graph.consumers[i], isinstance(node, Consumer))
+
+        ids = graph.encode(graph.nodes)
+        for j, node in enumerate(graph.nodes):
+            want = [other.linked[node].dist if node in other.linked else float('inf') for other in graph.nodes]
+            self.assertEqual(graph.weights_to(ids, j).tolist(), want)
+            self.assertEqual(graph.road_weights(ids, graph.encode([node] * len(ids))).tolist(), want)
+
+        other = random_system(30, 4, seed=2)
+        other.consumers[0].unlink()
+        other.add_link(0, 1, 5.0, 5.0)
+        TransportSystem.Loader.dumps(tsys)
+        self.assertIs(tsys.graph, graph)
+
+        road = next(iter(tsys.consumers[0].linked.values()))
+        road.time += 1.0
+        self.assertIsNot(tsys.graph, graph)
+        self.assertIn(road.time, tsys.graph.time)
+        graph = tsys.graph
+
+        removed = len(tsys.consumers[0].linked)
+        tsys.consumers[0].unlink()
+        self.assertIsNot(tsys.graph, graph)
+        self.assertEqual(len(tsys.graph.neighbors), len(graph.neighbors) - 2 * removed)
+
+    def test_encoded_costs(self):
+        tsys = random_system(40, 4, seed=3)
+        routes = RouteBuilder(tsys, metric='time')._min_elem_routes()
+        graph = tsys.graph
+        encoded = [route.ids(graph) for route in routes] + [graph.encode([tsys.parking])]
+
+        costs = graph.costs(encoded, 'time')
+        self.assertEqual(len(costs), len(routes) + 1)
+        for route, ids, cost in zip(routes, encoded, costs):
+            self.assertEqual(Route.from_ids(ids, graph).nodes, route.nodes)
+            self.assertAlmostEqual(cost, route.cost)
+            self.assertAlmostEqual(graph.cost(ids, 'time'), route.cost)
+        self.assertEqual(costs[-1], 0.0)
+
+    def test_shared_paths(self):
+        tsys = random_system(60, 6, seed=7)
+        road_map = RoadMap(tsys)
+        road_map.find_routes(tsys.parking)
+        routes = [road_map.route(tsys.parking, node) for node in tsys.nodes]
+
+        cells = {id(cell) for route in routes for cell in route.path.cells()}
+        self.assertEqual(len(cells), len(tsys.nodes))
+        for route, node in zip(routes, tsys.nodes):
+            self.assertEqual(route.nodes, road_map.path(tsys.parking, node))
+            self.assertAlmostEqual(route.dist, road_map.dist(tsys.parking, node))
+
+    def test_memory_limit(self):
+        tsys = random_system(60, 6, seed=8)
+        want = RoadMap(tsys)
+        road_map = RoadMap(tsys, memory_limit=RoadMap(tsys).tree_size * 3)
+
+        for node in tsys.nodes:
+            for other in tsys.nodes[:5]:
+                self.assertAlmostEqual(road_map.route(node, other).dist, want.dist(node, other))
+                road_map.find_routes(node)
+            self.assertLessEqual(len(road_map.dists), 3)
+            self.assertLessEqual(road_map.memory_size, road_map.memory_limit)
+
+    def test_cache_file(self):
+        tsys = random_system(40, 4, seed=9)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for map_type in (RoadMap, MatrixRoadMap):
+                with self.subTest(map_type=map_type):
+                    road_map = map_type(tsys, cache_dir=cache_dir)
+                    for node in tsys.nodes[:5]:
+                        road_map.find_routes(node)
+                    road_map.save()
+
+                    loaded = map_type(tsys, cache_dir=cache_dir)
+                    self.assertEqual(len(loaded.dists), len(road_map.dists))
+                    for node in tsys.nodes[:5]:
+                        self.assertEqual(list(loaded.preds[node]), list(road_map.preds[node]))
+                        self.assertEqual(loaded.route(node, tsys.parking).nodes,
+                                         road_map.route(node, tsys.parking).nodes)
+
+    def test_shared_maps(self):
+        tsys = random_system(30, 3, seed=7)
+        cache = RoadMapCache()
+        road_map = cache.get(tsys)
+        road_map.find_routes(tsys.parking)
+        self.assertIs(cache.get(tsys), road_map)
+        self.assertIsNot(cache.get(tsys, MatrixRoadMap), road_map)
+
+        node = tsys.consumers[0]
+        node.add_node(tsys.parking, Road(0.01))
+        self.assertIs(cache.get(tsys), road_map)
+        self.assertAlmostEqual(road_map.dist(tsys.parking, node), 0.01)
+
+        for metric, other in (('dist', 'time'), ('time', 'dist')):
+            road_map = cache.get(tsys, metric=metric)
+            route = road_map.route(tsys.parking, tsys.warehouses[0])
+            road = route.nodes[0].linked[route.nodes[1]]
+            setattr(road, other, getattr(road, other) + 100)
+            self.assertIs(cache.get(tsys, metric=metric), road_map)
+            route = road_map.route(tsys.parking, tsys.warehouses[0])
+            self.assertAlmostEqual(route.length(other), Route(*route.nodes).length(other))
+
+    def test_matrix_files(self):
+        for filename in ['test1', 'test2', 'test12']:
+            with self.subTest(filename=filename):
+                tsys = TransportSystem.Loader.load(f'./configs/{filename}.json')
+                want = RouteBuilder(tsys).calc_routes()
+                tsys = TransportSystem.Loader.load(f'./configs/{filename}.json')
+                routes = RouteBuilder(tsys, MatrixRoadMap(tsys)).calc_routes()
+                self.assertEqual(len(routes), len(want))
+
 
 if __name__ == '__main__':
     unittest.main()
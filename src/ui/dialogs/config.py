@@ -2,16 +2,20 @@ from typing import Optional
 
 from PyQt5.QtCore import Qt, QTime
 from PyQt5.QtWidgets import QDialog, QHBoxLayout, QSpacerItem, QSizePolicy, QVBoxLayout, QPushButton, \
-    QMessageBox, QLabel, QSlider, QCheckBox, QTimeEdit, QDoubleSpinBox
+    QMessageBox, QLabel, QSlider, QCheckBox, QTimeEdit, QDoubleSpinBox, QComboBox
 
 from entities import Route, GeoNode
 from entities.route_builder import MAX_ITER
 
 import datetime as dt
 
+METRICS = {'dist': 'протяжённость', 'time': 'время в пути'}
+
+
 class GUIConfig(object):
     def __init__(self):
         self.iters = MAX_ITER
+        self.time_budget = 0.0
         self.show_labels = True
 
         self.cur_node: Optional[GeoNode] = None
@@ -21,6 +25,7 @@ class GUIConfig(object):
         self.end_t = dt.timedelta(hours=18)
 
         self.prod_volume = 0.1
+        self.metric = 'dist'
 
 
 class ConfigDialog(QDialog):
@@ -53,9 +58,11 @@ class ConfigDialog(QDialog):
 
         self.title_UI()
         self.max_iter_UI()
+        self.time_budget_UI()
         self.show_labels_UI()
         self.schedule_UI()
         self.prod_volume_UI()
+        self.metric_UI()
 
         self.content.addItem(QSpacerItem(40, 10, QSizePolicy.Fixed, QSizePolicy.Minimum))
         self.buttons_UI()
@@ -84,6 +91,20 @@ class ConfigDialog(QDialog):
         self.content.addItem(layout)
         self.content.addItem(QSpacerItem(40, 10, QSizePolicy.Fixed, QSizePolicy.Minimum))
 
+    def time_budget_UI(self):
+        layout = QHBoxLayout()
+
+        layout.addWidget(QLabel('Ограничение времени (0 - без ограничения)', self))
+
+        self.time_budgetW = QDoubleSpinBox(self)
+        self.time_budgetW.setRange(0, 3600)
+        self.time_budgetW.setValue(self.config.time_budget)
+        self.time_budgetW.setSingleStep(1)
+        layout.addWidget(self.time_budgetW)
+
+        layout.addWidget(QLabel('с', self))
+        self.content.addItem(layout)
+
     def show_labels_UI(self):
         layout = QVBoxLayout()
 
@@ -123,6 +144,19 @@ class ConfigDialog(QDialog):
         layout.addWidget(QLabel('м³', self))
         self.content.addItem(layout)
 
+    def metric_UI(self):
+        layout = QHBoxLayout()
+
+        layout.addWidget(QLabel('Минимизировать', self))
+
+        self.metricW = QComboBox(self)
+        for metric, title in METRICS.items():
+            self.metricW.addItem(title, metric)
+        self.metricW.setCurrentIndex(list(METRICS).index(self.config.metric))
+        layout.addWidget(self.metricW)
+
+        self.content.addItem(layout)
+
     def buttons_UI(self):
         layout = QHBoxLayout()
 
@@ -134,6 +168,7 @@ class ConfigDialog(QDialog):
 
     def update_config(self):
         self.config.iters = self.iterW.value()
+        self.config.time_budget = self.time_budgetW.value()
         self.config.show_labels = self.show_labelsW.isChecked()
 
         t = self.begin_timeW.time().toPyTime()
@@ -143,6 +178,7 @@ class ConfigDialog(QDialog):
         self.config.end_t = dt.timedelta(hours=t.hour, minutes=t.minute)
 
         self.config.prod_volume = self.prod_volumeW.value()
+        self.config.metric = self.metricW.currentData()
 
     def apply(self):
         try:
@@ -122,7 +122,7 @@ class NodeDialog(QDialog):
         self.close()
 
     def add_new_link(self):
-        node_list = self.sys.nodes
+        node_list = list(self.sys.nodes)
         node_list.remove(self.source_node)
 
         for i in range(self.linkW.count()):
@@ -135,7 +135,7 @@ class NodeDialog(QDialog):
             self.add_link(node_list[0])
 
     def add_link(self, other: GeoNode):
-        node_list = self.sys.nodes
+        node_list = list(self.sys.nodes)
         node_list.remove(self.source_node)
         widget = LinkField(self, other, node_list)
 